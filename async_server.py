@@ -0,0 +1,185 @@
+import logging
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from server import Server
+from outbox import AsyncOutbox
+from protocol import FrameDecoder, decode_packet, is_legacy_packet
+
+logger = logging.getLogger(__name__)
+
+class AsyncServer(Server):
+    """Server engine that multiplexes all connections on one asyncio event loop"""
+    # Idle connections cost a coroutine instead of a thread; blocking work
+    # (bcrypt, SQLite) runs on a small worker pool through the shared Server code
+
+    def __init__(self, host="0.0.0.0", port=5555, worker_threads=8, **options):
+        """Initialize server with host, port and worker pool size"""
+        super().__init__(host, port, **options)
+        self.worker_threads = worker_threads
+        self.loop = None
+        self.executor = None
+        self.login_executor = None
+        self.loop_thread = None
+        self.async_server = None
+        self.writers = set()
+        self.connection_tasks = set()
+
+    def start(self):
+        """Start the server"""
+        # Run the event loop in a background thread so start() returns like Server.start()
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.worker_threads, thread_name_prefix="forum-worker")
+
+        # Logins wait on the bcrypt pool; on their own threads a login storm
+        # cannot take every worker away from chat packets
+        self.login_executor = ThreadPoolExecutor(max_workers=max(1, self.auth.processes) * 4, thread_name_prefix="forum-login")
+        started = threading.Event()
+        startup_error = []
+        self.start_services()
+
+        self.loop_thread = threading.Thread(target=self.run_loop, args=(started, startup_error))
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        started.wait()
+
+        if startup_error:
+            self.stop_services()
+            self.executor.shutdown(wait=False)
+            self.login_executor.shutdown(wait=False)
+            logger.error("Error starting server: %s", startup_error[0])
+            return False
+
+        logger.info("Server started on %s:%s (asyncio engine)", self.host, self.port)
+        return True
+
+    def run_loop(self, started, startup_error):
+        """Create the listening socket and run the event loop until stopped"""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.async_server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle_connection, self.host, self.port, backlog=self.backlog,
+                                     reuse_address=True, reuse_port=self.reuse_port)
+            )
+        except Exception as e:
+            startup_error.append(e)
+            started.set()
+            self.loop.close()
+            return
+
+        started.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        """Stop the server"""
+        # Close the listener and all client transports from inside the loop
+        self.running = False
+        if self.loop and self.loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+            try:
+                future.result(timeout=5)
+            except Exception as e:
+                logger.error("Error stopping server: %s", e)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join(timeout=5)
+
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        if self.login_executor:
+            self.login_executor.shutdown(wait=False)
+
+        self.stop_services()
+        logger.info("Server stopped")
+
+    async def shutdown(self):
+        """Close the listening socket and every open connection"""
+        if self.async_server:
+            self.async_server.close()
+            await self.async_server.wait_closed()
+
+        # Abort rather than close so unsent data for stalled clients is dropped
+        for writer in list(self.writers):
+            writer.transport.abort()
+
+        # Give connection handlers a chance to run their cleanup, then cancel stragglers
+        if self.connection_tasks:
+            await asyncio.wait(list(self.connection_tasks), timeout=2)
+
+        leftover = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in leftover:
+            task.cancel()
+        await asyncio.gather(*leftover, return_exceptions=True)
+
+    async def handle_connection(self, reader, writer):
+        """Handle communication with a connected client"""
+        # Authenticate the client and process their messages
+        address = writer.get_extra_info("peername")
+        logger.info("Connection from %s", address)
+        self.writers.add(writer)
+        self.connection_tasks.add(asyncio.current_task())
+        client = None
+        decoder = FrameDecoder()
+
+        # Worker threads queue frames; a writer task owns the transport
+        outbox = AsyncOutbox(self.loop, self.outbox_size, self.overflow_policy, metrics=self.metrics)
+        writer_task = self.loop.create_task(outbox.run_writer(writer))
+        self.metrics.add("connections.opened")
+
+        try:
+            # First frame should be login credentials
+            frames = []
+            while not frames:
+                data = await reader.read(4096)
+                if not data:
+                    return
+                self.metrics.add("bytes.in", len(data))
+                if is_legacy_packet(data) and not decoder.pending():
+                    self.reject_legacy_client(writer.write)
+                    return
+                frames = decoder.feed(data)
+
+            client = await self.loop.run_in_executor(
+                self.login_executor, self.login_client, decode_packet(frames[0]), outbox
+            )
+            if client:
+                # Handle any frames that arrived together with the login
+                for frame in frames[1:]:
+                    await self.loop.run_in_executor(self.executor, self.handle_packet, client, decode_packet(frame))
+
+                await self.handle_stream(reader, client, decoder)
+
+        except Exception as e:
+            logger.error("Error handling client %s: %s", address, e)
+        finally:
+            if client:
+                await self.loop.run_in_executor(self.executor, self.logout_client, client)
+
+            # Let the writer flush what is already queued before closing
+            outbox.close()
+            try:
+                await asyncio.wait_for(writer_task, timeout=5)
+            except Exception:
+                writer_task.cancel()
+
+            self.writers.discard(writer)
+            self.connection_tasks.discard(asyncio.current_task())
+            writer.close()
+            self.metrics.add("connections.closed")
+
+    async def handle_stream(self, reader, client, decoder):
+        """Handle incoming messages from a client"""
+        # Packets from one connection are processed in order on the worker pool
+        while self.running:
+            try:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.metrics.add("bytes.in", len(data))
+
+                for frame in decoder.feed(data):
+                    await self.loop.run_in_executor(self.executor, self.handle_packet, client, decode_packet(frame))
+
+            except Exception as e:
+                logger.error("Error receiving message from %s: %s", client.username, e)
+                break
@@ -0,0 +1,101 @@
+import multiprocessing
+import threading
+import secrets
+import time
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor
+from utils import verify_password
+
+# Live sessions kept; past this the oldest are dropped and those clients log in with the password again
+MAX_SESSIONS = 10000
+
+class Authenticator:
+    """Verifies passwords on a process pool and issues resumable session tokens"""
+
+    def __init__(self, processes=2, token_ttl=12 * 60 * 60):
+        """Initialize with the number of bcrypt worker processes and token lifetime"""
+        # processes=0 verifies inline on the calling thread
+        self.processes = processes
+        self.token_ttl = token_ttl
+        self.pool = None
+
+        # token -> (username, expiry). Every token gets the same lifetime when
+        # added, so insertion order is expiry order and the oldest are in front
+        self.tokens = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # Bound the logins waiting on the pool; extra callers block instead of queueing forever
+        self.slots = threading.BoundedSemaphore(max(1, processes) * 4)
+
+    def start(self):
+        """Start the bcrypt worker processes"""
+        if self.processes and not self.pool:
+            # spawn avoids forking a process that may be running Tk and client threads
+            context = multiprocessing.get_context("spawn")
+            self.pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+
+    def stop(self):
+        """Shut the worker processes down and forget all sessions"""
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+        with self.lock:
+            self.tokens.clear()
+
+    def submit(self, stored_password, provided_password):
+        """Start verifying a password, returning a future with the result"""
+        if not self.pool:
+            future = Future()
+            future.set_result(verify_password(stored_password, provided_password))
+            return future
+        return self.pool.submit(verify_password, stored_password, provided_password)
+
+    def verify(self, stored_password, provided_password):
+        """Verify a password against its hash without holding the GIL for the bcrypt work"""
+        if not provided_password:
+            return False
+
+        with self.slots:
+            return self.submit(stored_password, provided_password).result()
+
+    def issue_token(self, username):
+        """Create a session token that can be presented instead of the password"""
+        token = secrets.token_urlsafe(32)
+        self.adopt(token, username)
+        return token
+
+    def adopt(self, token, username):
+        """Accept a session token issued by another server process"""
+        now = time.monotonic()
+        with self.lock:
+            self.tokens[token] = (username, now + self.token_ttl)
+            self.tokens.move_to_end(token)
+
+            # Expired sessions are all at the front, then the oldest go past the limit
+            while self.tokens:
+                oldest_token, (_, expires) = next(iter(self.tokens.items()))
+                if expires > now and len(self.tokens) <= MAX_SESSIONS:
+                    break
+                del self.tokens[oldest_token]
+
+    def resume(self, token, username):
+        """Check that a session token is live and belongs to the given user"""
+        with self.lock:
+            session = self.tokens.get(token)
+            if not session:
+                return False
+
+            owner, expires = session
+            if time.monotonic() > expires:
+                del self.tokens[token]
+                return False
+
+        return secrets.compare_digest(owner, username or "")
+
+    def revoke(self, token, username=None):
+        """Invalidate a session token, only if it belongs to username when one is given"""
+        with self.lock:
+            session = self.tokens.get(token)
+            if session and (username is None or session[0] == username):
+                del self.tokens[token]
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from message_writer import DURABILITY_MODES
+from protocol import CLIENT_CAPABILITIES, FRAMING_CAPABILITY, COMPACT_CAPABILITY, COMPRESSION_CAPABILITY, FrameDecoder, encode_packet, decode_packet, codec_for
+from server import ENGINES
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_PREFIX = "bench "
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of values fall"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(values, scale=1000.0):
+    """Return p50/p99/max of a list of seconds, in milliseconds"""
+    if not values:
+        return {"count": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * scale, 3),
+        "p99_ms": round(percentile(values, 0.99) * scale, 3),
+        "max_ms": round(max(values) * scale, 3)
+    }
+
+class BenchClient:
+    """One simulated client connection speaking the framed protocol"""
+
+    def __init__(self, index, username, password, probe, capabilities=CLIENT_CAPABILITIES):
+        """Initialize a connection; probes decode every frame to measure latency"""
+        self.index = index
+        self.username = username
+        self.password = password
+        self.probe = probe
+        self.capabilities = capabilities
+        self.codec = None
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.frames = 0
+        self.latencies = []
+        self.login_latency = None
+        self.token = None
+
+    async def login(self, host, port, token=None):
+        """Connect, log in and return once the login response arrives"""
+        # With a session token the server skips the bcrypt check, like a reconnect
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        login_data = {
+            "type": "login",
+            "username": self.username,
+            "password": self.password,
+            "capabilities": list(self.capabilities)
+        }
+        if token:
+            login_data["token"] = token
+        self.writer.write(encode_packet(login_data))
+
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection during login")
+            frames = self.decoder.feed(data)
+            if frames:
+                break
+
+        response = decode_packet(frames[0])
+        if not response.get("success"):
+            raise ConnectionError(response.get("message", "Login failed"))
+
+        self.login_latency = time.perf_counter() - started
+        self.token = response.get("token")
+        self.codec = codec_for(response.get("capabilities"))
+        self.count(frames[1:])
+
+    async def read_forever(self):
+        """Count incoming frames until the connection closes"""
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.count(self.decoder.feed(data))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def count(self, frames):
+        """Record delivered frames, and broadcast latency on probe connections"""
+        self.frames += len(frames)
+        if not self.probe:
+            return
+
+        now = time.perf_counter()
+        for frame in frames:
+            packet = decode_packet(frame)
+            content = packet.get("content")
+            if packet.get("type") == "message" and isinstance(content, str) and content.startswith(BENCH_PREFIX):
+                self.latencies.append(now - float(content.split()[3]))
+
+    async def send_messages(self, rate, duration, stats):
+        """Send bench messages at a fixed rate for duration seconds"""
+        interval = 1.0 / rate
+        deadline = time.perf_counter() + duration
+        next_send = time.perf_counter()
+        sequence = 0
+        while next_send < deadline:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # The send time rides in the content so probes can compute latency
+            content = f"{BENCH_PREFIX}{self.index} {sequence} {time.perf_counter():.6f}"
+            self.writer.write(self.codec.encode({"type": "message", "content": content}))
+            await self.writer.drain()
+            stats["sent"] += 1
+            sequence += 1
+            next_send += interval
+
+    def finish(self):
+        """Tell the server nothing more will be sent"""
+        if self.writer and self.writer.can_write_eof():
+            self.writer.write_eof()
+
+    def close(self):
+        """Close the connection"""
+        if self.writer:
+            self.writer.close()
+
+class ServerProcess:
+    """A headless server started on a scratch database for the benchmark"""
+
+    def __init__(self, engine, port, users, password, persistence, workers=1):
+        """Initialize the scratch directory and server options"""
+        self.engine = engine
+        self.workers = workers
+        self.port = port
+        self.users = users
+        self.password = password
+        self.persistence = persistence
+        self.directory = tempfile.TemporaryDirectory(prefix="forum-bench-")
+        self.db_file = os.path.join(self.directory.name, "forum.db")
+        self.process = None
+        self.peak_rss = 0
+
+    def create_users(self):
+        """Create the benchmark accounts before the server opens the database"""
+        from database import Database
+        db = Database(self.db_file)
+        for i in range(self.users):
+            db.add_user(f"bench{i}", self.password)
+        db.close()
+
+    def start(self):
+        """Start the server process and wait until it accepts connections"""
+        self.create_users()
+        command = [
+            sys.executable, "-m", "headless_server",
+            "--port", str(self.port),
+            "--engine", self.engine,
+            "--workers", str(self.workers),
+            "--db", self.db_file,
+            "--archive-dir", os.path.join(self.directory.name, "archive"),
+            "--persistence", self.persistence,
+            "--backlog", "4096",
+            "--log-level", "WARNING"
+        ]
+        self.process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.5).close()
+                return
+            except OSError:
+                if self.process.poll() is not None:
+                    raise RuntimeError("Server process exited during startup")
+                time.sleep(0.1)
+        raise RuntimeError("Server did not start listening within 30 seconds")
+
+    def sample(self):
+        """Record the resident memory of the server's processes, where /proc is available"""
+        rss = sum(read_proc_rss(pid) or 0 for pid in process_tree(self.process.pid))
+        if rss:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def cpu_seconds(self):
+        """Return the user plus system CPU time of the server's processes, where /proc is available"""
+        # Workers and bcrypt processes count too; children that already exited do not
+        total = 0
+        try:
+            for pid in process_tree(self.process.pid):
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+        except (OSError, ValueError, IndexError):
+            return None
+        return total / os.sysconf("SC_CLK_TCK")
+
+    def stop(self):
+        """Stop the server and remove the scratch database"""
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.directory.cleanup()
+
+def process_tree(pid):
+    """Return a process id followed by those of all its descendants, from /proc"""
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def read_proc_rss(pid):
+    """Return a process's resident set size in bytes from /proc, or None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit permits"""
+    if resource:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def run_benchmark(args, server=None):
+    """Run the login storm and message phases and return the results"""
+    capabilities = (FRAMING_CAPABILITY,) + ((COMPACT_CAPABILITY,) if args.codec == COMPACT_CAPABILITY else ())
+    if args.compress:
+        capabilities += (COMPRESSION_CAPABILITY,)
+    clients = [
+        BenchClient(i, f"{args.user_prefix}{i % args.users}", args.password, i < args.probes, capabilities)
+        for i in range(args.connections)
+    ]
+
+    # Login storm: every connection logs in at once, up to login_concurrency in flight
+    slots = asyncio.Semaphore(args.login_concurrency)
+    failures = []
+    tokens = {}
+
+    async def login(client):
+        async with slots:
+            try:
+                await client.login(args.host, args.port, tokens.get(client.username))
+            except (OSError, ConnectionError) as e:
+                failures.append(str(e))
+
+    # With --resume-tokens one connection per account logs in with its password
+    # first, and the storm itself is made of token resumes
+    if args.resume_tokens:
+        first = clients[:args.users]
+        await asyncio.gather(*(login(client) for client in first))
+        tokens = {client.username: client.token for client in first if client.token}
+        clients_in_storm = clients[args.users:]
+    else:
+        clients_in_storm = clients
+
+    storm_started = time.perf_counter()
+    await asyncio.gather(*(login(client) for client in clients_in_storm))
+    storm_seconds = time.perf_counter() - storm_started
+    storm_logins = [client.login_latency for client in clients_in_storm if client.login_latency is not None]
+    connected = [client for client in clients if client.login_latency is not None]
+
+    readers = [asyncio.ensure_future(client.read_forever()) for client in connected]
+    await asyncio.sleep(0.5)
+    for client in connected:
+        client.frames = 0
+        client.latencies = []
+
+    # Message phase: senders share the total rate
+    stats = {"sent": 0}
+    senders = connected[:args.senders]
+    cpu_before = server.cpu_seconds() if server else None
+    sampler = asyncio.ensure_future(sample_forever(server)) if server else None
+
+    started = time.perf_counter()
+    if senders:
+        await asyncio.gather(*(sender.send_messages(args.rate / len(senders), args.duration, stats) for sender in senders))
+    send_seconds = time.perf_counter() - started
+
+    # Let in-flight broadcasts arrive before counting
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started
+    cpu_after = server.cpu_seconds() if server else None
+
+    # Every connection is in the default room, so each message should reach all of them;
+    # counted before teardown, whose leave notices are not part of the run
+    delivered = sum(client.frames for client in connected)
+    expected = stats["sent"] * len(connected)
+
+    if sampler:
+        sampler.cancel()
+    # Half-close and read until the server hangs up, so no connection is reset
+    # with frames still unread
+    for client in connected:
+        client.finish()
+    try:
+        await asyncio.wait_for(asyncio.gather(*readers, return_exceptions=True), timeout=10)
+    except asyncio.TimeoutError:
+        pass
+    for client in connected:
+        client.close()
+
+    latencies = [latency for client in connected for latency in client.latencies]
+
+    return {
+        "connections": {
+            "requested": args.connections,
+            "connected": len(connected),
+            "failed": len(failures),
+            "errors": sorted(set(failures))[:5]
+        },
+        "login": {
+            "storm_seconds": round(storm_seconds, 3),
+            "logins": len(storm_logins),
+            "logins_per_second": round(len(storm_logins) / storm_seconds, 1) if storm_seconds else None,
+            "latency": summarize(storm_logins)
+        },
+        "messages": {
+            "sent": stats["sent"],
+            "send_rate": round(stats["sent"] / send_seconds, 1) if send_seconds else None,
+            "delivered": delivered,
+            "expected": expected,
+            "delivery_ratio": round(delivered / expected, 4) if expected else None,
+            "deliveries_per_second": round(delivered / elapsed, 1) if elapsed else None,
+            "broadcast_latency": summarize(latencies)
+        },
+        "server": {
+            "peak_rss_bytes": server.peak_rss if server else None,
+            "cpu_seconds": round(cpu_after - cpu_before, 3) if cpu_before is not None and cpu_after is not None else None
+        },
+        "bench_process": {
+            "cpu_seconds": round(sum(os.times()[:2]), 3),
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None
+        }
+    }
+
+async def sample_forever(server, interval=0.25):
+    """Sample server memory until cancelled"""
+    while True:
+        server.sample()
+        await asyncio.sleep(interval)
+
+def parse_args(argv=None):
+    """Parse command line options for the benchmark"""
+    parser = argparse.ArgumentParser(description="Load-test the LAN forum server and report JSON results")
+    parser.add_argument("--codec", choices=("json", COMPACT_CAPABILITY), default="json", help="wire encoding the clients negotiate")
+    parser.add_argument("--compress", action="store_true", help="negotiate compression of large frames")
+    parser.add_argument("--engine", choices=ENGINES, default="asyncio", help="engine of the server started for the run")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the server started for the run")
+    parser.add_argument("--persistence", choices=DURABILITY_MODES, default="batched", help="persistence mode of the server started for the run")
+    parser.add_argument("--external", action="store_true", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--host", default="127.0.0.1", help="server address")
+    parser.add_argument("--port", type=int, default=5599, help="server port")
+    parser.add_argument("--connections", type=int, default=200, help="simulated client connections")
+    parser.add_argument("--login-concurrency", type=int, default=1000, help="logins in flight at once during the storm")
+    parser.add_argument("--users", type=int, default=10, help="accounts shared by the connections")
+    parser.add_argument("--user-prefix", default="bench", help="account names are this prefix plus a number")
+    parser.add_argument("--password", default="benchpass1", help="password of the benchmark accounts")
+    parser.add_argument("--resume-tokens", action="store_true", help="log in the storm with session tokens instead of passwords")
+    parser.add_argument("--senders", type=int, default=10, help="connections that send messages")
+    parser.add_argument("--rate", type=float, default=100.0, help="total messages per second across all senders")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for deliveries after sending stops")
+    parser.add_argument("--probes", type=int, default=20, help="connections that measure broadcast latency")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Run the benchmark and write its JSON results"""
+    args = parse_args(argv)
+    raise_file_limit()
+
+    server = None
+    if not args.external:
+        server = ServerProcess(args.engine, args.port, args.users, args.password, args.persistence, args.workers)
+        server.start()
+
+    try:
+        results = asyncio.run(run_benchmark(args, server))
+    finally:
+        if server:
+            server.stop()
+
+    results["config"] = {key: value for key, value in vars(args).items() if key not in ("password", "output")}
+    results["host"] = {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+    results["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
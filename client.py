@@ -1,19 +1,50 @@
 import socket
 import threading
+import time
 import json
+from protocol import DEFAULT_ROOM, CLIENT_CAPABILITIES, FRAMING_CAPABILITY, JSON_CODEC, FrameDecoder, encode_packet, decode_packet, is_legacy_packet, codec_for
 
 class Client:
-    def __init__(self, host="127.0.0.1", port=5555):
+    def __init__(self, host="127.0.0.1", port=5555, auto_reconnect=True):
         """Initialize client with host and port"""
         self.host = host
         self.port = port
+        self.auto_reconnect = auto_reconnect
         self.client_socket = None
+        self.decoder = None
+        
+        # The Tk thread and the receive thread (rejoining rooms after a reconnect)
+        # both send; a frame must go out whole before the next one starts
+        self.send_lock = threading.Lock()
+        self.pending_frames = []
+        self.codec = JSON_CODEC
         self.connected = False
         self.username = None
+        self.password = None
+        self.session_token = None
         self.role = None
         self.message_callback = None
+        self.history_page_callback = None
+        self.history_reset_callback = None
+        self.rooms_callback = None
+        self.direct_message_callback = None
+        self.search_results_callback = None
+        self.stats_callback = None
         self.on_connect_callback = None
         self.on_disconnect_callback = None
+        
+        # Rooms we are subscribed to; kept across reconnects so they can be rejoined
+        self.rooms = []
+        
+        # Scroll-back state per room: the oldest message we hold and whether the server has more
+        self.oldest_message_ids = {}
+        self.has_older_messages = {}
+        self.history_requests_pending = set()
+        
+        # Newest message id per room, sent on reconnect so the server only sends the gap
+        self.last_seen_ids = {}
+        self.last_dm_id = None
+        self.reconnecting = False
     
     def connect(self):
         """Connect to the server"""
@@ -28,6 +59,7 @@ class Client:
     def disconnect(self):
         """Disconnect from the server"""
         self.connected = False
+        self.reconnecting = False
         if self.client_socket:
             self.client_socket.close()
             self.client_socket = None
@@ -44,19 +76,37 @@ class Client:
         login_data = {
             "type": "login",
             "username": username,
-            "password": password
+            "password": password,
+            "capabilities": list(CLIENT_CAPABILITIES)
         }
+        if DEFAULT_ROOM in self.last_seen_ids:
+            login_data["last_seen_id"] = self.last_seen_ids[DEFAULT_ROOM]
+        if self.last_dm_id is not None and username == self.username:
+            login_data["last_dm_id"] = self.last_dm_id
+        
+        # Resume the previous session without another bcrypt check on the server
+        if self.session_token and username == self.username:
+            login_data["token"] = self.session_token
         
         try:
-            self.client_socket.send(json.dumps(login_data).encode('utf-8'))
+            # The login packet and its response are always JSON
+            self.codec = JSON_CODEC
+            with self.send_lock:
+                self.client_socket.sendall(encode_packet(login_data))
             
             # Wait for response
-            response_data = self.client_socket.recv(1024).decode('utf-8')
-            response = json.loads(response_data)
+            response = self.receive_login_response()
+            
+            if response.get("success") and FRAMING_CAPABILITY not in response.get("capabilities", []):
+                self.client_socket.close()
+                return False, "Server does not support this client's protocol"
             
             if response.get("success"):
+                self.codec = codec_for(response.get("capabilities"))
                 self.connected = True
                 self.username = username
+                self.password = password
+                self.session_token = response.get("token")
                 self.role = response.get("role")
                 
                 # Start listening for messages
@@ -64,6 +114,12 @@ class Client:
                 receive_thread.daemon = True
                 receive_thread.start()
                 
+                # The server puts us in the default room; rejoin the rest after a reconnect
+                previous_rooms = [room for room in self.rooms if room != DEFAULT_ROOM]
+                self.rooms = [DEFAULT_ROOM]
+                for room in previous_rooms:
+                    self.join_room(room)
+                
                 if self.on_connect_callback:
                     self.on_connect_callback(self.username, self.role)
                 
@@ -76,56 +132,271 @@ class Client:
             self.client_socket.close()
             return False, f"Error during login: {e}"
     
+    def receive_login_response(self):
+        """Read frames until the login response arrives"""
+        self.decoder = FrameDecoder()
+        frames = []
+        while not frames:
+            data = self.client_socket.recv(4096)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            
+            # A server that predates framing answers with bare JSON
+            if is_legacy_packet(data) and not self.decoder.pending():
+                return json.loads(data.decode('utf-8'))
+            frames = self.decoder.feed(data)
+        
+        # Anything that arrived with the response is handled by the receive loop
+        self.pending_frames = frames[1:]
+        return decode_packet(frames[0])
+    
     def receive_messages(self):
         """Continuously receive messages from the server"""
+        frames, self.pending_frames = self.pending_frames, []
         while self.connected:
             try:
-                data = self.client_socket.recv(4096).decode('utf-8')
+                for frame in frames:
+                    self.handle_packet(decode_packet(frame))
+                
+                data = self.client_socket.recv(65536)
                 if not data:
                     break
                 
-                message_data = json.loads(data)
-                
-                # Process different message types
-                if message_data.get("type") == "message":
-                    if self.message_callback:
-                        self.message_callback(
-                            message_data.get("username"),
-                            message_data.get("content"),
-                            message_data.get("timestamp"),
-                            message_data.get("system", False)
-                        )
-                
-                elif message_data.get("type") == "message_history":
-                    messages = message_data.get("messages", [])
-                    for msg in messages:
-                        if self.message_callback:
-                            self.message_callback(
-                                msg.get("username"),
-                                msg.get("content"),
-                                msg.get("timestamp"),
-                                False
-                            )
+                frames = self.decoder.feed(data)
             
             except Exception as e:
                 print(f"Error receiving message: {e}")
                 break
         
+        # If we exit the loop while still "connected", the link dropped under us
+        if self.connected and self.auto_reconnect and self.reconnect():
+            return
+        
         # If we exit the loop, connection is lost
         self.disconnect()
     
-    def send_message(self, content):
-        """Send a message to the server"""
-        if not self.connected:
-            return False
+    def reconnect(self, attempts=5, delay=1.0):
+        """Log in again with the saved credentials after a dropped connection"""
+        # The login carries last_seen_id, so the server only sends what we missed
+        self.connected = False
+        self.reconnecting = True
+        if self.client_socket:
+            self.client_socket.close()
+            self.client_socket = None
+        
+        for attempt in range(attempts):
+            time.sleep(delay * (attempt + 1))
+            
+            # Stop if the user disconnected while we were waiting
+            if not self.reconnecting:
+                return False
+            success, message = self.login(self.username, self.password)
+            if success:
+                self.reconnecting = False
+                return True
+            print(f"Reconnect attempt {attempt + 1} failed: {message}")
+        
+        self.reconnecting = False
+        return False
+    
+    def handle_packet(self, message_data):
+        """Dispatch a single packet received from the server"""
+        # Process different message types
+        packet_type = message_data.get("type")
+        room = message_data.get("room", DEFAULT_ROOM)
+        
+        if packet_type == "message":
+            self.track_message_id(room, message_data.get("id"))
+            if self.message_callback:
+                self.message_callback(
+                    message_data.get("username"),
+                    message_data.get("content"),
+                    message_data.get("timestamp"),
+                    message_data.get("system", False),
+                    room,
+                    message_data.get("id")
+                )
+        
+        elif packet_type == "message_history":
+            messages = message_data.get("messages", [])
+            
+            # A resync (since_id present) continues our existing history
+            if messages and "since_id" not in message_data:
+                self.oldest_message_ids[room] = messages[0].get("id")
+                self.has_older_messages[room] = True
+            
+            for msg in messages:
+                self.track_message_id(room, msg.get("id"))
+                if self.message_callback:
+                    self.message_callback(
+                        msg.get("username"),
+                        msg.get("content"),
+                        msg.get("timestamp"),
+                        False,
+                        room,
+                        msg.get("id")
+                    )
+        
+        elif packet_type == "history_reset":
+            # We were too far behind; a full history follows
+            self.last_seen_ids.pop(room, None)
+            self.oldest_message_ids.pop(room, None)
+            self.has_older_messages[room] = False
+            if self.history_reset_callback:
+                self.history_reset_callback(room)
+        
+        elif packet_type == "history_page":
+            messages = message_data.get("messages", [])
+            if messages:
+                self.oldest_message_ids[room] = messages[0].get("id")
+            self.has_older_messages[room] = message_data.get("has_more", False) and bool(messages)
+            self.history_requests_pending.discard(room)
+            
+            if self.history_page_callback:
+                self.history_page_callback(messages, room)
+        
+        elif packet_type == "direct_message":
+            self.handle_direct_message(message_data)
+        
+        elif packet_type == "direct_history":
+            # Without since_id this is the whole recent conversation, not a continuation
+            if "since_id" not in message_data:
+                self.last_dm_id = 0
+            for msg in message_data.get("messages", []):
+                self.handle_direct_message(msg)
+        
+        elif packet_type == "search_results":
+            if self.search_results_callback:
+                self.search_results_callback(
+                    message_data.get("messages", []),
+                    message_data.get("offset", 0),
+                    message_data.get("has_more", False)
+                )
+        
+        elif packet_type == "stats":
+            if self.stats_callback:
+                self.stats_callback(message_data.get("stats", {}))
         
+        elif packet_type == "room_joined":
+            if room not in self.rooms:
+                self.rooms.append(room)
+            if self.rooms_callback:
+                self.rooms_callback(list(self.rooms))
+        
+        elif packet_type == "room_left":
+            if room in self.rooms:
+                self.rooms.remove(room)
+            self.last_seen_ids.pop(room, None)
+            if self.rooms_callback:
+                self.rooms_callback(list(self.rooms))
+        
+        elif packet_type == "error":
+            print(f"Server error: {message_data.get('message')}")
+    
+    def handle_direct_message(self, message):
+        """Record a direct message and pass it to the callback"""
+        message_id = message.get("id")
+        if message_id is not None and message_id > (self.last_dm_id or 0):
+            self.last_dm_id = message_id
+        
+        if self.direct_message_callback:
+            self.direct_message_callback(
+                message.get("sender"),
+                message.get("recipient"),
+                message.get("content"),
+                message.get("timestamp")
+            )
+    
+    def track_message_id(self, room, message_id):
+        """Remember the newest message id seen in a room"""
+        if message_id is not None and message_id > self.last_seen_ids.get(room, 0):
+            self.last_seen_ids[room] = message_id
+    
+    def send_message(self, content, room=DEFAULT_ROOM):
+        """Send a message to a room"""
         message_data = {
             "type": "message",
+            "room": room,
+            "content": content
+        }
+        
+        return self.send_packet(message_data)
+    
+    def send_direct_message(self, recipient, content):
+        """Send a private message to one user"""
+        message_data = {
+            "type": "direct_message",
+            "to": recipient,
             "content": content
         }
         
+        return self.send_packet(message_data)
+    
+    def join_room(self, room):
+        """Ask the server to subscribe us to a room"""
+        request = {"type": "join_room", "room": room}
+        if room in self.last_seen_ids:
+            request["last_seen_id"] = self.last_seen_ids[room]
+        return self.send_packet(request)
+    
+    def leave_room(self, room):
+        """Ask the server to unsubscribe us from a room"""
+        return self.send_packet({"type": "leave_room", "room": room})
+    
+    def request_older_messages(self, room=DEFAULT_ROOM, limit=50):
+        """Ask the server for the page of messages before the oldest one we have"""
+        oldest_id = self.oldest_message_ids.get(room)
+        if room in self.history_requests_pending or not self.has_older_messages.get(room) or oldest_id is None:
+            return False
+        
+        request = {
+            "type": "history_before",
+            "room": room,
+            "before_id": oldest_id,
+            "limit": limit
+        }
+        
+        # Marked before sending; the reply can arrive before send_packet returns
+        self.history_requests_pending.add(room)
+        if not self.send_packet(request):
+            self.history_requests_pending.discard(room)
+            return False
+        return True
+    
+    def search(self, query, username=None, room=None, since=None, until=None, offset=0, limit=20):
+        """Ask the server for messages matching a full-text query"""
+        request = {
+            "type": "search",
+            "query": query,
+            "offset": offset,
+            "limit": limit
+        }
+        
+        # Optional filters; since/until are "YYYY-MM-DD[ HH:MM:SS]" strings, until is exclusive
+        for key, value in (("username", username), ("room", room), ("since", since), ("until", until)):
+            if value:
+                request[key] = value
+        
+        return self.send_packet(request)
+    
+    def request_stats(self):
+        """Ask the server for its metrics; only answered for admins"""
+        return self.send_packet({"type": "stats"})
+    
+    def forget_older_messages(self, room, before_id):
+        """Move a room's scroll-back cursor forward after the view dropped messages below before_id"""
+        self.oldest_message_ids[room] = before_id
+        self.has_older_messages[room] = True
+    
+    def send_packet(self, packet):
+        """Send a packet to the server"""
+        if not self.connected:
+            return False
+        
         try:
-            self.client_socket.send(json.dumps(message_data).encode('utf-8'))
+            frame = self.codec.encode(packet)
+            with self.send_lock:
+                self.client_socket.sendall(frame)
             return True
         except Exception as e:
             print(f"Error sending message: {e}")
@@ -136,6 +407,30 @@ class Client:
         """Set callback for received messages"""
         self.message_callback = callback
     
+    def set_history_page_callback(self, callback):
+        """Set callback for pages of older messages"""
+        self.history_page_callback = callback
+    
+    def set_history_reset_callback(self, callback):
+        """Set callback for when the server restarts our history from scratch"""
+        self.history_reset_callback = callback
+    
+    def set_rooms_callback(self, callback):
+        """Set callback for changes to the list of joined rooms"""
+        self.rooms_callback = callback
+    
+    def set_direct_message_callback(self, callback):
+        """Set callback for received direct messages"""
+        self.direct_message_callback = callback
+    
+    def set_search_results_callback(self, callback):
+        """Set callback for pages of search results"""
+        self.search_results_callback = callback
+    
+    def set_stats_callback(self, callback):
+        """Set callback for server statistics"""
+        self.stats_callback = callback
+    
     def set_connect_callback(self, callback):
         """Set callback for successful connection"""
         self.on_connect_callback = callback
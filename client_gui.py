@@ -1,7 +1,14 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 from client import Client
-import datetime
+from protocol import DEFAULT_ROOM
+from utils import validate_room_name
+from message_view import MessageRecord, MessageView, format_message
+import queue
+
+# Received messages are drawn in batches at most every RENDER_INTERVAL_MS
+RENDER_INTERVAL_MS = 50
+MAX_EVENTS_PER_FRAME = 1000
 
 class ClientGUI:
     def __init__(self, root):
@@ -13,12 +20,18 @@ class ClientGUI:
         
         self.client = Client()
         
+        # Client callbacks arrive on its receive thread; they are queued here and
+        # run by process_ui_queue on the Tk thread
+        self.ui_queue = queue.SimpleQueue()
+        self.pending_records = []
+        
         # Create frames
         self.create_login_frame()
         self.create_chat_frame()
         
         # Show login frame first
         self.show_login_frame()
+        self.root.after(RENDER_INTERVAL_MS, self.process_ui_queue)
     
     def create_login_frame(self):
         """Create the login frame"""
@@ -71,13 +84,43 @@ class ClientGUI:
         # Logout button
         ttk.Button(self.header_frame, text="Logout", command=self.logout).pack(side=tk.RIGHT)
         
+        # Search box; "from:<user>" and "in:<room>" words narrow the search
+        ttk.Button(self.header_frame, text="Search", command=self.search).pack(side=tk.RIGHT, padx=5)
+        self.search_var = tk.StringVar()
+        search_entry = ttk.Entry(self.header_frame, textvariable=self.search_var, width=25)
+        search_entry.pack(side=tk.RIGHT)
+        search_entry.bind("<Return>", self.search)
+        self.search_window = None
+        self.search_request = None
+        
+        # Room bar: the room messages are sent to, plus join/leave controls
+        self.room_frame = ttk.Frame(self.chat_frame)
+        self.room_frame.pack(fill=tk.X, pady=5)
+        
+        ttk.Label(self.room_frame, text="Room:").pack(side=tk.LEFT)
+        self.room_var = tk.StringVar(value=DEFAULT_ROOM)
+        self.room_combo = ttk.Combobox(self.room_frame, textvariable=self.room_var, values=[DEFAULT_ROOM], state="readonly", width=20)
+        self.room_combo.pack(side=tk.LEFT, padx=5)
+        self.room_combo_rooms = [DEFAULT_ROOM]
+        self.room_var.trace_add("write", lambda *args: self.show_room(self.room_var.get()))
+        
+        ttk.Button(self.room_frame, text="Leave", command=self.leave_room).pack(side=tk.LEFT)
+        
+        ttk.Button(self.room_frame, text="Join", command=self.join_room).pack(side=tk.RIGHT)
+        self.new_room_var = tk.StringVar()
+        new_room_entry = ttk.Entry(self.room_frame, textvariable=self.new_room_var, width=20)
+        new_room_entry.pack(side=tk.RIGHT, padx=5)
+        new_room_entry.bind("<Return>", self.join_room)
+        
         # Messages area
         self.messages_frame = ttk.Frame(self.chat_frame)
         self.messages_frame.pack(fill=tk.BOTH, expand=True, pady=10)
         
-        self.messages_text = scrolledtext.ScrolledText(self.messages_frame, wrap=tk.WORD)
-        self.messages_text.pack(fill=tk.BOTH, expand=True)
-        self.messages_text.config(state=tk.DISABLED)
+        # One view per joined room, so each keeps its own timeline, scroll-back
+        # and resets; direct messages are shown in all of them
+        self.message_views = {}
+        self.message_view = None
+        self.show_room(DEFAULT_ROOM)
         
         # Message input area
         self.input_frame = ttk.Frame(self.chat_frame)
@@ -121,10 +164,15 @@ class ClientGUI:
         # Update client connection details
         self.client = Client(server_ip, server_port)
         
-        # Set callbacks
-        self.client.set_message_callback(self.on_message_received)
-        self.client.set_connect_callback(self.on_connected)
-        self.client.set_disconnect_callback(self.on_disconnected)
+        # Set callbacks; each one is run later on the Tk thread
+        self.client.set_message_callback(self.in_ui_thread(self.on_message_received))
+        self.client.set_history_page_callback(self.in_ui_thread(self.on_history_page))
+        self.client.set_history_reset_callback(self.in_ui_thread(self.on_history_reset))
+        self.client.set_rooms_callback(self.in_ui_thread(self.on_rooms_changed))
+        self.client.set_direct_message_callback(self.in_ui_thread(self.on_direct_message))
+        self.client.set_search_results_callback(self.in_ui_thread(self.on_search_results))
+        self.client.set_connect_callback(self.in_ui_thread(self.on_connected))
+        self.client.set_disconnect_callback(self.in_ui_thread(self.on_disconnected))
         
         # Attempt login
         self.status_var.set("Connecting...")
@@ -154,53 +202,224 @@ class ClientGUI:
         messagebox.showinfo("Disconnected", "You have been disconnected from the server.")
         self.show_login_frame()
     
-    def on_message_received(self, username, content, timestamp, system=False):
-        """Handle received message"""
-        self.messages_text.config(state=tk.NORMAL)
+    def in_ui_thread(self, handler):
+        """Wrap a client callback so it is queued for the Tk thread instead of run in place"""
+        return lambda *args: self.ui_queue.put((handler, args))
+    
+    def process_ui_queue(self):
+        """Run queued client callbacks and draw the messages they produced"""
+        # Consecutive messages only collect their pieces; anything else first
+        # draws what has been collected so the view stays in arrival order
+        batched = (self.on_message_received, self.on_direct_message)
+        for _ in range(MAX_EVENTS_PER_FRAME):
+            try:
+                handler, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            
+            if handler not in batched:
+                self.flush_messages()
+            handler(*args)
         
-        # Format timestamp
-        try:
-            # Parse the datetime string
-            dt = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-            # Format it in a more readable way
-            time_str = dt.strftime("%H:%M:%S")
-        except:
-            time_str = timestamp
-        
-        # Add the message with formatting
-        if system:
-            self.messages_text.insert(tk.END, f"[{time_str}] ", "time")
-            self.messages_text.insert(tk.END, f"{content}\n", "system")
-        else:
-            self.messages_text.insert(tk.END, f"[{time_str}] ", "time")
-            self.messages_text.insert(tk.END, f"{username}: ", "username")
-            self.messages_text.insert(tk.END, f"{content}\n", "message")
+        self.flush_messages()
+        self.root.after(RENDER_INTERVAL_MS, self.process_ui_queue)
+    
+    def on_message_received(self, username, content, timestamp, system=False, room=DEFAULT_ROOM, message_id=None):
+        """Collect a received message for the next batched draw"""
+        kind = "system" if system else "message"
+        self.pending_records.append(MessageRecord(message_id, room, username, content, timestamp, kind))
+    
+    def on_direct_message(self, sender, recipient, content, timestamp):
+        """Collect a received or echoed direct message for the next batched draw"""
+        self.pending_records.append(MessageRecord(None, None, f"{sender} -> {recipient}", content, timestamp, "direct"))
+    
+    def flush_messages(self):
+        """Append every collected message to its room's view, one insert per view"""
+        if not self.pending_records:
+            return
         
-        # Configure tags
-        self.messages_text.tag_configure("time", foreground="gray")
-        self.messages_text.tag_configure("username", foreground="blue", font=("Helvetica", 10, "bold"))
-        self.messages_text.tag_configure("message", foreground="black")
-        self.messages_text.tag_configure("system", foreground="green", font=("Helvetica", 10, "italic"))
+        batches = {}
+        for record in self.pending_records:
+            if record.kind == "direct":
+                for view in self.message_views.values():
+                    batches.setdefault(view, []).append(record)
+            else:
+                batches.setdefault(self.view_for(record.room), []).append(record)
+        self.pending_records = []
         
-        # Scroll to bottom
-        self.messages_text.see(tk.END)
-        self.messages_text.config(state=tk.DISABLED)
+        for view, records in batches.items():
+            view.append(records)
+    
+    def view_for(self, room):
+        """Return a room's message view, creating it on first use"""
+        view = self.message_views.get(room)
+        if view is None:
+            view = MessageView(self.messages_frame, lambda: self.on_messages_top(room), self.on_messages_trimmed)
+            self.message_views[room] = view
+        return view
+    
+    def show_room(self, room):
+        """Show the message view of the selected room"""
+        view = self.view_for(room)
+        if view is self.message_view:
+            return
+        if self.message_view:
+            self.message_view.pack_forget()
+        self.message_view = view
+        view.pack(fill=tk.BOTH, expand=True)
+    
+    def on_history_page(self, messages, room=DEFAULT_ROOM):
+        """Insert a page of older messages above the ones the room's view holds"""
+        self.view_for(room).prepend([
+            MessageRecord(msg.get("id"), room, msg.get("username"), msg.get("content"), msg.get("timestamp"))
+            for msg in messages
+        ])
+    
+    def on_history_reset(self, room):
+        """Drop a room's messages; the server follows a reset with fresh history for that room"""
+        self.pending_records = [record for record in self.pending_records if record.room != room]
+        self.view_for(room).clear()
+    
+    def on_messages_top(self, room):
+        """Fetch older messages when a room's view reaches the oldest one it holds"""
+        if self.client and self.client.connected:
+            self.client.request_older_messages(room)
+    
+    def on_messages_trimmed(self, room, before_id):
+        """Let the client fetch messages the view dropped to save memory again"""
+        if self.client:
+            self.client.forget_older_messages(room, before_id)
     
     def send_message(self, event=None):
         """Send a message to the server"""
         content = self.message_var.get().strip()
         if content:
-            if self.client.send_message(content):
+            # "/msg <user> <text>" sends a direct message instead of posting to the room
+            if content.startswith("/msg "):
+                parts = content.split(None, 2)
+                if len(parts) < 3:
+                    messagebox.showerror("Error", "Usage: /msg <username> <message>")
+                    return "break"
+                sent = self.client.send_direct_message(parts[1], parts[2])
+            else:
+                sent = self.client.send_message(content, self.room_var.get())
+            
+            if sent:
                 self.message_var.set("")  # Clear input field
             else:
                 messagebox.showerror("Error", "Failed to send message. You may be disconnected.")
         return "break"  # Prevent default behavior for Enter key
     
+    def search(self, event=None):
+        """Start a new search from the search box"""
+        words = self.search_var.get().split()
+        filters = {}
+        terms = []
+        for word in words:
+            if word.startswith("from:") and len(word) > 5:
+                filters["username"] = word[5:]
+            elif word.startswith("in:") and len(word) > 3:
+                filters["room"] = word[3:]
+            else:
+                terms.append(word)
+        
+        if not terms:
+            return "break"
+        
+        self.search_request = (" ".join(terms), filters)
+        self.open_search_window()
+        self.search_results_text.config(state=tk.NORMAL)
+        self.search_results_text.delete("1.0", tk.END)
+        self.search_results_text.config(state=tk.DISABLED)
+        
+        if not self.client.search(self.search_request[0], **filters):
+            messagebox.showerror("Error", "Failed to search. You may be disconnected.")
+        return "break"
+    
+    def search_more(self):
+        """Request the next page of the current search"""
+        if self.search_request:
+            query, filters = self.search_request
+            self.more_results_button.config(state=tk.DISABLED)
+            self.client.search(query, offset=self.search_offset, **filters)
+    
+    def open_search_window(self):
+        """Show the search results window, creating it if needed"""
+        if self.search_window and self.search_window.winfo_exists():
+            self.search_window.lift()
+            return
+        
+        self.search_window = tk.Toplevel(self.root)
+        self.search_window.title("Search results")
+        self.search_window.geometry("500x400")
+        
+        self.search_results_text = scrolledtext.ScrolledText(self.search_window, wrap=tk.WORD)
+        self.search_results_text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.search_results_text.tag_configure("time", foreground="gray")
+        self.search_results_text.tag_configure("room", foreground="purple")
+        self.search_results_text.tag_configure("username", foreground="blue", font=("Helvetica", 10, "bold"))
+        self.search_results_text.tag_configure("message", foreground="black")
+        self.search_results_text.config(state=tk.DISABLED)
+        
+        self.more_results_button = ttk.Button(self.search_window, text="More results", command=self.search_more, state=tk.DISABLED)
+        self.more_results_button.pack(pady=5)
+        self.search_offset = 0
+    
+    def on_search_results(self, messages, offset, has_more):
+        """Callback when a page of search results arrives"""
+        if not (self.search_window and self.search_window.winfo_exists()):
+            return
+        
+        self.search_results_text.config(state=tk.NORMAL)
+        if not messages and offset == 0:
+            self.search_results_text.insert(tk.END, "No messages found\n", "time")
+        for msg in messages:
+            pieces = format_message(msg.get("username"), msg.get("content"), msg.get("timestamp"), room=msg.get("room"))
+            for text, tag in pieces:
+                self.search_results_text.insert(tk.END, text, tag)
+        self.search_results_text.config(state=tk.DISABLED)
+        
+        self.search_offset = offset + len(messages)
+        self.more_results_button.config(state=tk.NORMAL if has_more else tk.DISABLED)
+    
+    def join_room(self, event=None):
+        """Join the room typed in the room entry"""
+        room = self.new_room_var.get().strip()
+        if not validate_room_name(room):
+            messagebox.showerror("Error", "Invalid room name! Must be 1-32 characters, alphanumeric, underscores and dashes only.")
+            return "break"
+        
+        if self.client.join_room(room):
+            self.new_room_var.set("")
+        return "break"
+    
+    def leave_room(self):
+        """Leave the currently selected room"""
+        room = self.room_var.get()
+        if room != DEFAULT_ROOM:
+            self.client.leave_room(room)
+    
+    def on_rooms_changed(self, rooms):
+        """Callback when the list of joined rooms changes"""
+        joined = [room for room in rooms if room not in self.room_combo_rooms]
+        self.room_combo_rooms = rooms
+        self.room_combo.config(values=rooms)
+        
+        # Switch to a newly joined room, or fall back if the selected one was left
+        if joined:
+            self.room_var.set(joined[-1])
+        elif self.room_var.get() not in rooms:
+            self.room_var.set(DEFAULT_ROOM)
+        
+        # Views of rooms that were left go with them
+        for room in [room for room, view in self.message_views.items() if room not in rooms and view is not self.message_view]:
+            self.message_views.pop(room).destroy()
+    
     def clear_messages(self):
-        """Clear the messages area"""
-        self.messages_text.config(state=tk.NORMAL)
-        self.messages_text.delete(1.0, tk.END)
-        self.messages_text.config(state=tk.DISABLED)
+        """Clear the messages area of every room"""
+        self.pending_records = []
+        for view in self.message_views.values():
+            view.clear()
     
     def on_close(self):
         """Handle window close event"""
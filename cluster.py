@@ -0,0 +1,458 @@
+import logging
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import itertools
+import threading
+import collections
+import multiprocessing
+from database import Database
+from outbox import ThreadedOutbox
+from protocol import JSON_CODEC, COMPACT_CODEC, FrameDecoder, decode_packet
+from server_log import start_background_logging
+
+logger = logging.getLogger(__name__)
+
+# Frames between the hub and the workers use the compact codec where it is installed
+BUS_CODEC = COMPACT_CODEC or JSON_CODEC
+
+# A worker this far behind the hub is cut off instead of holding the others up
+LINK_QUEUE_FRAMES = 100000
+LINK_QUEUE_BYTES = 64 * 1024 * 1024
+
+# The worker that writes messages to the database
+DB_OWNER = 0
+
+class Hub:
+    """Numbers messages from every worker and relays them to all workers in a single order"""
+    # Runs in the parent process. Each worker has one Unix socket link; what a
+    # worker publishes comes back to it like to everyone else, so every worker
+    # sees the same sequence of messages and presence changes
+
+    def __init__(self, path, last_id=0, last_direct_id=0):
+        """Initialize with the socket path and the last ids already in the database"""
+        self.path = path
+        self.ids = itertools.count(last_id + 1)
+        self.direct_ids = itertools.count(last_direct_id + 1)
+        self.lock = threading.Lock()
+        self.joined = threading.Condition(self.lock)
+        self.links = {}
+        self.ready = set()
+        self.presence = {}
+        self.listener = None
+
+        # Message frames relayed while the database owner was unlinked; it
+        # stores them when it links again, before anything newer
+        self.unpersisted = []
+
+    def start(self):
+        """Listen for worker links"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+
+        accept_thread = threading.Thread(target=self.accept_links)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def stop(self):
+        """Close the listener and every worker link"""
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+        with self.lock:
+            for outbox in self.links.values():
+                outbox.close(abort=True)
+            self.links.clear()
+
+    def wait_for_workers(self, count, timeout):
+        """Block until count workers are accepting clients, returning False on timeout"""
+        with self.joined:
+            return self.joined.wait_for(lambda: len(self.ready) >= count, timeout)
+
+    def accept_links(self):
+        """Accept worker connections"""
+        while self.listener:
+            try:
+                link_socket, _ = self.listener.accept()
+            except OSError:
+                break
+
+            link_thread = threading.Thread(target=self.handle_link, args=(link_socket,))
+            link_thread.daemon = True
+            link_thread.start()
+
+    def handle_link(self, link_socket):
+        """Read what one worker publishes until its link closes"""
+        decoder = FrameDecoder()
+        outbox = ThreadedOutbox(LINK_QUEUE_FRAMES, "disconnect", LINK_QUEUE_BYTES)
+        writer_thread = outbox.start_writer(link_socket)
+        index = None
+
+        try:
+            while True:
+                data = link_socket.recv(65536)
+                if not data:
+                    break
+
+                for frame in decoder.feed(data):
+                    packet = decode_packet(frame)
+                    if index is None:
+                        # The first frame names the worker
+                        index = packet["worker"]
+                        self.add_link(index, outbox)
+                    else:
+                        self.handle(index, packet)
+        except OSError:
+            pass
+        except Exception as e:
+            logger.error("Error on link to worker %s: %s", index, e)
+        finally:
+            if index is not None:
+                self.drop_link(index, outbox)
+            outbox.close()
+            writer_thread.join(timeout=5)
+            link_socket.close()
+
+    def add_link(self, index, outbox):
+        """Register a worker and tell it who is online on the others"""
+        with self.lock:
+            outbox.put(BUS_CODEC.encode({"op": "presence_snapshot", "online": self.online_counts()}))
+            if index == DB_OWNER and self.unpersisted:
+                logger.info("Replaying %d messages to worker %d for the database", len(self.unpersisted), index)
+                for frame in self.unpersisted:
+                    outbox.put(frame)
+                self.unpersisted = []
+            self.links[index] = outbox
+            self.presence[index] = collections.Counter()
+        logger.info("Worker %d linked to the hub", index)
+
+    def drop_link(self, index, outbox):
+        """Forget a worker and take its users' sessions off the presence counts"""
+        with self.lock:
+            if self.links.get(index) is not outbox:
+                return
+            del self.links[index]
+            self.ready.discard(index)
+            for username, count in self.presence.pop(index).items():
+                self.relay({"op": "presence", "username": username, "delta": -count})
+        logger.info("Worker %d unlinked from the hub", index)
+
+    def online_counts(self):
+        """Return the number of sessions per online user across all workers (called with the lock held)"""
+        counts = collections.Counter()
+        for presence in self.presence.values():
+            counts.update(presence)
+        return dict(counts)
+
+    def handle(self, index, packet):
+        """Number and relay one packet published by a worker"""
+        op = packet.get("op")
+
+        # The lock makes numbering and relaying one step, which is what gives
+        # every worker the same order
+        with self.lock:
+            if op == "message":
+                self.relay_stored({"op": "message", "message": {
+                    "id": next(self.ids),
+                    "room": packet["room"],
+                    "username": packet["username"],
+                    "timestamp": packet["timestamp"],
+                    "content": packet["content"]
+                }})
+            elif op == "direct":
+                self.relay_stored({"op": "direct", "message": {
+                    "id": next(self.direct_ids),
+                    "sender": packet["sender"],
+                    "recipient": packet["recipient"],
+                    "timestamp": packet["timestamp"],
+                    "content": packet["content"]
+                }})
+            elif op == "presence":
+                presence = self.presence[index]
+                presence[packet["username"]] += packet["delta"]
+                if presence[packet["username"]] <= 0:
+                    del presence[packet["username"]]
+                self.relay(packet)
+            elif op in ("notice", "token"):
+                self.relay(packet)
+            elif op == "ready":
+                self.ready.add(index)
+                self.joined.notify_all()
+
+    def relay(self, packet):
+        """Queue a packet for every worker (called with the lock held)"""
+        # Encoded once; every link shares the bytes
+        frame = BUS_CODEC.encode(packet)
+        for outbox in self.links.values():
+            outbox.put(frame)
+        return frame
+
+    def relay_stored(self, packet):
+        """Relay a numbered message, keeping it for the database owner if that is unlinked (called with the lock held)"""
+        frame = self.relay(packet)
+        if DB_OWNER not in self.links:
+            if len(self.unpersisted) >= LINK_QUEUE_FRAMES:
+                logger.error("Worker %d has been unlinked too long, message %d will not be stored", DB_OWNER, packet["message"]["id"])
+                return
+            self.unpersisted.append(frame)
+
+class WorkerBus:
+    """A worker's link to the hub"""
+
+    def __init__(self, server, path, index):
+        """Initialize for the worker's server, the hub socket path and the worker number"""
+        self.server = server
+        self.path = path
+        self.index = index
+        self.socket = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connected = False
+
+        # Sessions per username across the whole cluster, as relayed by the hub
+        self.presence = collections.Counter()
+
+    def connect(self):
+        """Connect to the hub and start relaying what it sends"""
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(self.path)
+        self.connected = True
+        self.publish({"op": "hello", "worker": self.index})
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Disconnect from the hub"""
+        self.connected = False
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def publish(self, packet):
+        """Send a packet to the hub"""
+        frame = BUS_CODEC.encode(packet)
+        try:
+            with self.lock:
+                self.socket.sendall(frame)
+        except OSError as e:
+            logger.error("Error publishing to the hub: %s", e)
+            self.connected = False
+
+    def publish_message(self, username, content, timestamp, room, system=False):
+        """Hand a chat message or system notice to the hub for every worker"""
+        self.publish({
+            "op": "notice" if system else "message",
+            "room": room,
+            "username": username,
+            "timestamp": timestamp,
+            "content": content
+        })
+
+    def publish_direct(self, sender, recipient, content, timestamp):
+        """Hand a direct message to the hub for numbering and delivery"""
+        self.publish({"op": "direct", "sender": sender, "recipient": recipient, "timestamp": timestamp, "content": content})
+
+    def publish_presence(self, username, online):
+        """Tell the other workers a session started or ended"""
+        self.publish({"op": "presence", "username": username, "delta": 1 if online else -1})
+
+    def share_token(self, token, username, revoked=None):
+        """Let the other workers resume a session token issued here, and drop the one it replaces"""
+        self.publish({"op": "token", "token": token, "username": username, "revoked": revoked})
+
+    def is_online(self, username):
+        """Check whether a user has a session on any worker"""
+        return self.presence.get(username, 0) > 0
+
+    def users_online(self):
+        """Return the number of users with a session on any worker"""
+        return len(self.presence)
+
+    def run(self):
+        """Apply what the hub relays until the link closes"""
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = self.socket.recv(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    self.dispatch(decode_packet(frame))
+        except OSError:
+            pass
+        except Exception as e:
+            logger.exception("Error applying a packet from the hub: %s", e)
+        finally:
+            if self.connected:
+                logger.error("Lost the link to the hub")
+            self.connected = False
+
+    def dispatch(self, packet):
+        """Apply one relayed packet to the local server"""
+        op = packet.get("op")
+        server = self.server
+
+        if op == "message":
+            # Only worker 0 persists; the others run their writer in memory mode
+            message = packet["message"]
+            server.writer.store(message)
+            server.deliver_message(message)
+
+        elif op == "notice":
+            server.deliver_notice(packet["content"], packet["timestamp"], packet["room"])
+
+        elif op == "direct":
+            message = packet["message"]
+            server.writer.store_direct(message)
+            server.deliver_direct(message)
+
+        elif op == "presence":
+            username = packet["username"]
+            self.presence[username] += packet["delta"]
+            if self.presence[username] <= 0:
+                del self.presence[username]
+
+        elif op == "presence_snapshot":
+            self.presence = collections.Counter(packet["online"])
+
+        elif op == "token":
+            server.auth.adopt(packet["token"], packet["username"])
+            if packet.get("revoked"):
+                server.auth.revoke(packet["revoked"], packet["username"])
+
+class Cluster:
+    """Runs a server engine in several worker processes that share one port"""
+    # The kernel spreads connections over the workers with SO_REUSEPORT, so
+    # bcrypt, encoding and socket I/O use every core instead of one GIL
+
+    def __init__(self, engine, host, port, workers, **options):
+        """Initialize with the engine, address, worker count and per-server options"""
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.options = options
+        self.db_file = options.get("db_file", "forum.db")
+        self.processes = {}
+        self.hub = None
+        self.directory = None
+        self.monitor_thread = None
+        self.running = False
+
+    def start(self):
+        """Start the hub and the workers"""
+        if not hasattr(socket, "SO_REUSEPORT"):
+            logger.error("Running several workers needs SO_REUSEPORT, which this platform lacks")
+            return False
+
+        # The schema is created, and the last ids read, before any worker opens the database
+        db = Database(self.db_file)
+        last_id, last_direct_id = db.get_last_message_id(), db.get_last_direct_message_id()
+        db.close()
+
+        self.directory = tempfile.mkdtemp(prefix="forum-bus-")
+        self.hub = Hub(os.path.join(self.directory, "hub.sock"), last_id, last_direct_id)
+        self.hub.start()
+
+        for index in range(self.workers):
+            self.start_worker(index)
+
+        if not self.hub.wait_for_workers(self.workers, timeout=30):
+            logger.error("Workers did not start within 30 seconds")
+            self.stop()
+            return False
+
+        self.running = True
+        self.monitor_thread = threading.Thread(target=self.monitor)
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
+
+        logger.info("Server started on %s:%s with %d %s workers", self.host, self.port, self.workers, self.engine)
+        return True
+
+    def start_worker(self, index):
+        """Start one worker process"""
+        # spawn gives each worker a fresh interpreter instead of a fork of this
+        # process and its hub threads
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(
+            target=run_worker,
+            args=(index, self.engine, self.host, self.port, self.hub.path, self.options, logging.getLogger().level),
+            name=f"forum-worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+
+    def monitor(self):
+        """Restart workers that exit while the cluster is running"""
+        while self.running:
+            for index, process in list(self.processes.items()):
+                if not process.is_alive() and self.running:
+                    logger.error("Worker %d exited with code %s, restarting it", index, process.exitcode)
+                    self.start_worker(index)
+            time.sleep(1)
+
+    def stop(self):
+        """Stop every worker, letting each flush its queues, then the hub"""
+        self.running = False
+        if self.monitor_thread:
+            self.monitor_thread.join()
+            self.monitor_thread = None
+
+        # SIGTERM makes each worker unwind through server.stop()
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=15)
+            if process.is_alive():
+                process.kill()
+        self.processes.clear()
+
+        if self.hub:
+            self.hub.stop()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        logger.info("Server stopped")
+
+def run_worker(index, engine, host, port, hub_path, options, log_level):
+    """Run one worker process until it is told to stop or loses the hub"""
+    listener = start_background_logging(level=log_level)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Only the database owner writes messages and applies retention
+    options = dict(options)
+    if index != DB_OWNER:
+        options.update(persistence="memory", retention_days=None, retention_rows=None)
+
+    from server import create_server
+    server = create_server(engine, host, port, reuse_port=True, **options)
+    server.bus = WorkerBus(server, hub_path, index)
+    try:
+        # Linked before accepting clients, so no broadcast is missed
+        server.bus.connect()
+        if not server.start():
+            return
+        server.bus.publish({"op": "ready"})
+        while server.running and server.bus.connected:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        server.bus.close()
+        listener.stop()
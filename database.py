@@ -1,12 +1,26 @@
+import logging
 import sqlite3
 import os
+import queue
+import threading
+import contextlib
 from utils import hash_password
+from protocol import DEFAULT_ROOM
+
+logger = logging.getLogger(__name__)
+
+# Columns of a message as clients see it; origin columns stay server-side
+MESSAGE_COLUMNS = "id, room, username, timestamp, content"
 
 class Database:
-    def __init__(self, db_file="forum.db"):
-        """Initialize database connection and create tables if they don't exist"""
+    def __init__(self, db_file="forum.db", pool_size=4):
+        """Initialize the connection pool and create tables if they don't exist"""
         self.db_file = db_file
-        self.conn = None
+        self.pool_size = pool_size
+        self.pool = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.search_enabled = True
         self.create_tables()
         
         # Create admin user if not exists
@@ -14,14 +28,59 @@ class Database:
             self.add_user("admin", "admin123", "admin")
     
     def connect(self):
-        """Connect to the SQLite database"""
-        self.conn = sqlite3.connect(self.db_file)
-        self.conn.row_factory = sqlite3.Row
-        return self.conn
+        """Open a new SQLite connection configured for concurrent use"""
+        # Pooled connections move between threads, and sqlite3 keeps a
+        # prepared-statement cache per connection that survives across calls
+        conn = sqlite3.connect(self.db_file, timeout=10, check_same_thread=False, cached_statements=64)
+        conn.row_factory = sqlite3.Row
+        
+        # Lets retention hand freed pages back in small steps; only takes effect
+        # on a new database, so it has to come before the WAL switch
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        
+        # WAL lets history reads run while a message is being written
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    @contextlib.contextmanager
+    def connection(self):
+        """Check a pooled connection out for the duration of a with block"""
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.pool_size
+                if can_open:
+                    self.opened += 1
+            conn = self.connect() if can_open else self.pool.get()
+        
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.put(conn)
+    
+    def close(self):
+        """Close every idle pooled connection"""
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.opened -= 1
     
     def create_tables(self):
         """Create the necessary database tables if they don't exist"""
-        conn = self.connect()
+        with self.connection() as conn:
+            self.create_schema(conn)
+    
+    def create_schema(self, conn):
+        """Create the users and messages tables on a connection"""
         cursor = conn.cursor()
         
         # Create users table
@@ -38,73 +97,430 @@ class Database:
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL DEFAULT 'general',
             username TEXT NOT NULL,
             timestamp TEXT NOT NULL,
             content TEXT NOT NULL
         )
         ''')
         
+        # Databases created before rooms existed get the column added in place
+        columns = [row["name"] for row in cursor.execute("PRAGMA table_info(messages)")]
+        if "room" not in columns:
+            cursor.execute("ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT 'general'")
+        
+        # Messages relayed by a peer server keep the node they were first posted
+        # on and their id there; both are NULL for messages posted locally
+        if "origin" not in columns:
+            cursor.execute("ALTER TABLE messages ADD COLUMN origin TEXT")
+            cursor.execute("ALTER TABLE messages ADD COLUMN origin_id INTEGER")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_origin ON messages (origin, origin_id) WHERE origin IS NOT NULL")
+        
+        # Newest origin id stored per peer node, kept even after retention
+        # archives that node's messages
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS peer_watermarks (
+            origin TEXT PRIMARY KEY,
+            origin_id INTEGER NOT NULL
+        )
+        ''')
+        
+        # Per-room history and scroll-back walk this index instead of the whole table
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)")
+        
+        # Create direct messages table, indexed for each side of the conversation
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS direct_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            content TEXT NOT NULL
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_direct_messages_recipient_id ON direct_messages (recipient, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_direct_messages_sender_id ON direct_messages (sender, id)")
+        
+        # Ranges of messages moved out to compressed archive files by retention
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            first_timestamp TEXT NOT NULL,
+            last_timestamp TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            path TEXT NOT NULL
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_archive_segments_room_last_id ON archive_segments (room, last_id)")
+        
+        self.create_search_index(cursor)
         conn.commit()
-        conn.close()
     
-    def add_user(self, username, password, role="user"):
-        """Add a new user to the database"""
-        conn = self.connect()
-        cursor = conn.cursor()
+    def create_search_index(self, cursor):
+        """Create the FTS5 index over message content and the triggers that maintain it"""
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
         
+        # External-content table: the text lives once, in messages, and the
+        # index only stores tokens keyed by message id
         try:
-            hashed_password = hash_password(password)
             cursor.execute(
-                "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                (username, hashed_password, role)
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')"
             )
-            conn.commit()
-            result = True
-        except sqlite3.IntegrityError:
-            # Username already exists
-            result = False
-        finally:
-            conn.close()
+        except sqlite3.OperationalError as e:
+            logger.warning("Full-text search disabled: %s", e)
+            self.search_enabled = False
+            return
+        
+        # Every write path, including the batch writer's executemany, goes through these
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''')
+        
+        # Messages stored before the index existed are indexed once
+        if not exists:
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    
+    def add_user(self, username, password, role="user"):
+        """Add a new user to the database"""
+        hashed_password = hash_password(password)
+        
+        with self.connection() as conn:
+            try:
+                conn.execute(
+                    "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                    (username, hashed_password, role)
+                )
+                conn.commit()
+                result = True
+            except sqlite3.IntegrityError:
+                # Username already exists
+                conn.rollback()
+                result = False
         
         return result
     
     def get_user(self, username):
         """Get user information by username"""
-        conn = self.connect()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        with self.connection() as conn:
+            user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
         
-        conn.close()
         return dict(user) if user else None
     
-    def save_message(self, username, content, timestamp):
+    def get_users(self):
+        """Get every username and role, ordered by username"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT username, role FROM users ORDER BY username").fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def save_message(self, username, content, timestamp, room=DEFAULT_ROOM):
         """Save a new message to the database"""
-        conn = self.connect()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO messages (room, username, timestamp, content) VALUES (?, ?, ?, ?)",
+                (room, username, timestamp, content)
+            )
+            conn.commit()
         
-        cursor.execute(
-            "INSERT INTO messages (username, timestamp, content) VALUES (?, ?, ?)",
-            (username, timestamp, content)
-        )
+        return True
+    
+    def save_messages(self, rows):
+        """Save a batch of (id, room, username, timestamp, content, origin, origin_id) rows in one transaction"""
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT INTO messages (id, room, username, timestamp, content, origin, origin_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            
+            # Relayed rows move their node's watermark in the same transaction
+            relayed = [(row[5], row[6]) for row in rows if row[5] is not None]
+            if relayed:
+                conn.executemany(
+                    """
+                    INSERT INTO peer_watermarks (origin, origin_id) VALUES (?, ?)
+                    ON CONFLICT (origin) DO UPDATE SET origin_id = MAX(origin_id, excluded.origin_id)
+                    """,
+                    relayed
+                )
+            conn.commit()
         
-        conn.commit()
-        conn.close()
         return True
     
-    def get_messages(self, limit=100):
-        """Get the most recent messages"""
-        conn = self.connect()
-        cursor = conn.cursor()
+    def get_last_message_id(self):
+        """Get the highest message id ever stored, or 0 if there never were any"""
+        # Archived and deleted messages still count, so their ids are never handed out again
+        with self.connection() as conn:
+            row = conn.execute(
+                """
+                SELECT MAX(
+                    (SELECT IFNULL(MAX(id), 0) FROM messages),
+                    (SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'messages'),
+                    (SELECT IFNULL(MAX(last_id), 0) FROM archive_segments)
+                )
+                """
+            ).fetchone()
         
-        cursor.execute(
-            "SELECT * FROM messages ORDER BY id DESC LIMIT ?",
-            (limit,)
-        )
+        return row[0] or 0
+
+    def get_peer_watermarks(self):
+        """Get the newest stored origin id of every peer node"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT origin, origin_id FROM peer_watermarks").fetchall()
+
+        return {row["origin"]: row["origin_id"] for row in rows}
+
+    def get_messages_from_origin(self, origin, after_id, limit=200):
+        """Get up to limit messages first posted on a node after its after_id, oldest first"""
+        # origin None means messages posted on this server, whose origin id is their id
+        with self.connection() as conn:
+            if origin is None:
+                rows = conn.execute(
+                    f"SELECT {MESSAGE_COLUMNS}, origin, origin_id FROM messages WHERE id > ? AND origin IS NULL ORDER BY id LIMIT ?",
+                    (after_id, limit)
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    f"SELECT {MESSAGE_COLUMNS}, origin, origin_id FROM messages WHERE origin = ? AND origin_id > ? ORDER BY origin_id LIMIT ?",
+                    (origin, after_id, limit)
+                ).fetchall()
+
+        return [dict(row) for row in rows]
+
+    def get_messages(self, limit=100, room=DEFAULT_ROOM):
+        """Get the most recent messages in a room"""
+        with self.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?",
+                (room, limit)
+            ).fetchall()
         
-        messages = [dict(row) for row in cursor.fetchall()]
+        messages = [dict(row) for row in rows]
         messages.reverse()  # Show oldest messages first
         
-        conn.close()
-        return messages
\ No newline at end of file
+        return messages
+    
+    def get_messages_before(self, before_id, limit=50, room=DEFAULT_ROOM):
+        """Get up to limit messages in a room older than before_id, oldest first"""
+        # Keyset pagination on (room, id): no OFFSET scan however far back
+        with self.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (room, before_id, limit)
+            ).fetchall()
+        
+        messages = [dict(row) for row in rows]
+        messages.reverse()
+        
+        return messages
+    
+    def get_messages_between(self, after_id, before_id, limit=200, room=DEFAULT_ROOM):
+        """Get up to limit messages in a room with after_id < id < before_id, oldest first"""
+        with self.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE room = ? AND id > ? AND id < ? ORDER BY id LIMIT ?",
+                (room, after_id, before_id, limit)
+            ).fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def count_messages_between(self, after_id, before_id, limit, room=DEFAULT_ROOM):
+        """Count messages in a room with after_id < id < before_id, stopping at limit"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM (SELECT 1 FROM messages WHERE room = ? AND id > ? AND id < ? LIMIT ?)",
+                (room, after_id, before_id, limit)
+            ).fetchone()
+        
+        return row[0]
+    
+    def save_direct_message(self, message_id, sender, recipient, timestamp, content):
+        """Save a direct message under a pre-assigned id"""
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO direct_messages (id, sender, recipient, timestamp, content) VALUES (?, ?, ?, ?, ?)",
+                (message_id, sender, recipient, timestamp, content)
+            )
+            conn.commit()
+        
+        return True
+    
+    def get_last_direct_message_id(self):
+        """Get the highest direct message id ever stored, or 0 if there never were any"""
+        with self.connection() as conn:
+            row = conn.execute(
+                """
+                SELECT MAX(
+                    (SELECT IFNULL(MAX(id), 0) FROM direct_messages),
+                    (SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'direct_messages')
+                )
+                """
+            ).fetchone()
+        
+        return row[0] or 0
+    
+    def get_direct_messages_after(self, username, after_id, limit=200):
+        """Get up to limit direct messages to or from a user with id > after_id, oldest first"""
+        # One branch per index; messages to yourself are only taken from the first
+        with self.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT * FROM (
+                    SELECT * FROM direct_messages WHERE recipient = ? AND id > ?
+                    UNION ALL
+                    SELECT * FROM direct_messages WHERE sender = ? AND recipient <> ? AND id > ?
+                ) ORDER BY id LIMIT ?
+                """,
+                (username, after_id, username, username, after_id, limit)
+            ).fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def get_recent_direct_messages(self, username, limit=100):
+        """Get the most recent direct messages to or from a user, oldest first"""
+        with self.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT * FROM (
+                    SELECT * FROM (SELECT * FROM direct_messages WHERE recipient = ? ORDER BY id DESC LIMIT ?)
+                    UNION ALL
+                    SELECT * FROM (SELECT * FROM direct_messages WHERE sender = ? AND recipient <> ? ORDER BY id DESC LIMIT ?)
+                ) ORDER BY id DESC LIMIT ?
+                """,
+                (username, limit, username, username, limit, limit)
+            ).fetchall()
+        
+        messages = [dict(row) for row in rows]
+        messages.reverse()  # Oldest first
+        
+        return messages
+    
+    def search_messages(self, query, username=None, room=None, since=None, until=None, limit=20, offset=0):
+        """Get messages matching a full-text query, best match first"""
+        match = build_match_expression(query)
+        if not match:
+            return []
+        
+        # The MATCH narrows to candidate ids through the index; the filters
+        # only look at those rows
+        sql = '''
+        SELECT m.id, m.room, m.username, m.timestamp, m.content
+        FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+        '''
+        params = [match]
+        
+        if username:
+            sql += " AND m.username = ?"
+            params.append(username)
+        if room:
+            sql += " AND m.room = ?"
+            params.append(room)
+        if since:
+            sql += " AND m.timestamp >= ?"
+            params.append(since)
+        if until:
+            sql += " AND m.timestamp < ?"
+            params.append(until)
+        
+        sql += " ORDER BY messages_fts.rank, m.id DESC LIMIT ? OFFSET ?"
+        params.extend((limit, offset))
+        
+        with self.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def get_message_rooms(self):
+        """Get every room that has stored messages"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT DISTINCT room FROM messages").fetchall()
+        
+        return [row[0] for row in rows]
+    
+    def get_row_limit_boundary(self, room, max_rows):
+        """Get the id of the newest message in a room beyond its newest max_rows, or 0"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT id FROM messages WHERE room = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (room, max_rows)
+            ).fetchone()
+        
+        return row[0] if row else 0
+    
+    def archive_messages(self, segment):
+        """Record an archive segment and delete the messages it holds in one transaction"""
+        with self.connection() as conn:
+            conn.execute(
+                """
+                INSERT INTO archive_segments
+                    (room, first_id, last_id, first_timestamp, last_timestamp, message_count, path)
+                VALUES (:room, :first_id, :last_id, :first_timestamp, :last_timestamp, :message_count, :path)
+                """,
+                segment
+            )
+            conn.execute(
+                "DELETE FROM messages WHERE room = ? AND id BETWEEN ? AND ?",
+                (segment["room"], segment["first_id"], segment["last_id"])
+            )
+            conn.commit()
+        
+        return True
+    
+    def get_archive_segments(self, room, before_id, limit=10):
+        """Get the newest archive segments of a room holding ids below before_id, newest first"""
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM archive_segments WHERE room = ? AND first_id < ? ORDER BY last_id DESC LIMIT ?",
+                (room, before_id, limit)
+            ).fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def compact(self, pages=1000):
+        """Return up to pages free pages to the filesystem and refresh planner statistics"""
+        with self.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                freed = 0
+            else:
+                before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+                freed = before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            
+            # Fold a bounded amount of the search index's segments together
+            if self.search_enabled:
+                conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('merge', 500)")
+                conn.commit()
+            
+            conn.execute("PRAGMA optimize")
+        
+        return freed
+
+def build_match_expression(query):
+    """Turn free text into an FTS5 query that matches every word"""
+    # Each word is quoted so user input can never be FTS5 syntax;
+    # a trailing * is kept as a prefix search
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return " ".join(terms)
\ No newline at end of file
@@ -0,0 +1,288 @@
+import hmac
+import socket
+import logging
+import threading
+from outbox import ThreadedOutbox
+from protocol import SERVER_CAPABILITIES, FrameDecoder, Packet, decode_packet, negotiate, codec_for
+from utils import validate_room_name
+
+logger = logging.getLogger(__name__)
+
+# A peer this far behind is cut off; it catches up from its watermarks when it reconnects
+PEER_QUEUE_FRAMES = 10000
+PEER_QUEUE_BYTES = 64 * 1024 * 1024
+
+# Messages per peer_messages packet while catching a peer up
+CATCH_UP_CHUNK = 200
+
+# Seconds between attempts to reach a configured peer
+RECONNECT_DELAY = 5
+CONNECT_TIMEOUT = 5
+
+class PeerLink:
+    """A connection to another forum server, handled by the engines like a client"""
+    __slots__ = ("node", "username", "send", "socket", "outbox")
+
+    def __init__(self, node, outbox):
+        """Initialize a link to the named node over an outbox"""
+        self.node = node
+        self.username = f"peer {node}"
+        self.send = outbox.put
+        self.socket = None
+        self.outbox = outbox
+
+class Federation:
+    """Relays room messages between this server and its peer servers"""
+    # Every message carries the node it was posted on and its id there. A
+    # node's messages are accepted, stored and forwarded in that id order, so
+    # the newest origin id seen per node (its watermark) is enough both to
+    # drop duplicates arriving over several links and to ask a peer for
+    # everything missed while the link was down
+
+    def __init__(self, server, node, peers=(), secret=None):
+        """Initialize with the local server, this node's name, host:port peers to dial and the shared secret"""
+        self.server = server
+        self.node = node
+        self.peers = [parse_peer(address) for address in peers]
+        self.secret = secret
+        self.links = set()
+        self.watermarks = server.db.get_peer_watermarks()
+        self.running = False
+        self.stopping = threading.Event()
+
+        # Accepting, numbering and forwarding happen under one lock, so every
+        # link carries each node's messages in origin id order
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start dialing the configured peers"""
+        self.running = True
+        self.stopping.clear()
+        for address in self.peers:
+            dial_thread = threading.Thread(target=self.dial, args=address)
+            dial_thread.daemon = True
+            dial_thread.start()
+
+    def stop(self):
+        """Stop dialing and drop every peer link"""
+        self.running = False
+        self.stopping.set()
+        with self.lock:
+            links = list(self.links)
+        for link in links:
+            link.outbox.close(abort=True)
+
+    def hello(self):
+        """Build the packet that opens a link to a peer"""
+        return {
+            "type": "peer_hello",
+            "node": self.node,
+            "secret": self.secret,
+            "capabilities": list(SERVER_CAPABILITIES),
+            "watermarks": self.watermark_vector()
+        }
+
+    def watermark_vector(self):
+        """Return the newest origin id seen from every other node"""
+        with self.lock:
+            return dict(self.watermarks)
+
+    def accept(self, hello, outbox):
+        """Answer a peer_hello on an incoming connection, returning the link or None"""
+        node = hello.get("node")
+        secret = hello.get("secret")
+        if not (isinstance(secret, str) and hmac.compare_digest(secret.encode("utf-8"), self.secret.encode("utf-8"))):
+            logger.warning("Refused a peer link from %s: wrong secret", node)
+            outbox.put({"type": "error", "message": "Peering refused"})
+            return None
+        if not isinstance(node, str) or not node or node == self.node:
+            logger.warning("Refused a peer link from node %r", node)
+            outbox.put({"type": "error", "message": "Peering refused: bad node name"})
+            return None
+
+        capabilities = negotiate(hello.get("capabilities"))
+        outbox.put({
+            "type": "peer_welcome",
+            "node": self.node,
+            "capabilities": capabilities,
+            "watermarks": self.watermark_vector()
+        })
+        outbox.codec = codec_for(capabilities)
+
+        # A peer gets a deeper queue than a client, and is cut off rather than
+        # losing frames when it falls behind
+        outbox.max_frames = PEER_QUEUE_FRAMES
+        outbox.max_bytes = PEER_QUEUE_BYTES
+        outbox.policy = "disconnect"
+
+        link = PeerLink(node, outbox)
+        return link if self.sync(link, hello.get("watermarks")) else None
+
+    def sync(self, link, watermarks):
+        """Send a new link everything it has not seen, then add it to the live links"""
+        if not isinstance(watermarks, dict):
+            watermarks = {}
+
+        sent = 0
+        with self.lock:
+            if not self.running:
+                return False
+
+            # Everything accepted so far is in the database once the writer has drained
+            self.server.writer.flush()
+
+            # Messages posted here (origin None), then those relayed from other nodes
+            for origin in [None] + sorted(self.watermarks):
+                if origin == link.node:
+                    continue
+                after_id = watermarks.get(origin or self.node, 0)
+                while True:
+                    rows = self.server.db.get_messages_from_origin(origin, after_id, CATCH_UP_CHUNK)
+                    if not rows:
+                        break
+                    if not link.send({"type": "peer_messages", "messages": [self.wire(row) for row in rows]}):
+                        return False
+                    after_id = rows[-1]["origin_id"] if origin else rows[-1]["id"]
+                    sent += len(rows)
+
+            # Added under the same lock, so live messages follow the catch-up without a gap
+            self.links.add(link)
+
+        logger.info("Linked to peer %s, sent %d missed messages", link.node, sent)
+        return True
+
+    def drop(self, link):
+        """Forget a closed link"""
+        with self.lock:
+            if link not in self.links:
+                return
+            self.links.discard(link)
+        logger.info("Peer %s unlinked", link.node)
+
+    def wire(self, message):
+        """Return a stored or new local message as it travels between nodes"""
+        return {
+            "origin": message.get("origin") or self.node,
+            "origin_id": message.get("origin_id") or message["id"],
+            "room": message["room"],
+            "username": message["username"],
+            "timestamp": message["timestamp"],
+            "content": message["content"]
+        }
+
+    def publish(self, username, content, timestamp, room):
+        """Store and deliver a message posted here, and forward it to every peer"""
+        with self.lock:
+            message = self.server.writer.save(username, content, timestamp, room)
+            self.server.deliver_message(message)
+            self.forward([self.wire(message)])
+
+    def receive(self, link, packet):
+        """Store, deliver and pass on the messages a peer relayed that are new here"""
+        messages = packet.get("messages") if packet.get("type") == "peer_messages" else None
+        if not isinstance(messages, list):
+            return
+
+        fresh = []
+        with self.lock:
+            for message in messages:
+                if not valid_wire_message(message):
+                    self.server.metrics.add("federation.invalid")
+                    continue
+
+                # Anything at or below the watermark already arrived over another link
+                origin, origin_id = message["origin"], message["origin_id"]
+                if origin == self.node or origin_id <= self.watermarks.get(origin, 0):
+                    self.server.metrics.add("federation.duplicates")
+                    continue
+                self.watermarks[origin] = origin_id
+
+                # Stored under a local id; the origin pair goes with it for later catch-ups
+                stored = self.server.writer.save(
+                    message["username"], message["content"], message["timestamp"], message["room"],
+                    origin, origin_id
+                )
+                self.server.deliver_message(stored)
+                fresh.append(message)
+
+            if fresh:
+                self.server.metrics.add("federation.received", len(fresh))
+                self.forward(fresh, exclude=link)
+
+    def forward(self, messages, exclude=None):
+        """Send messages to every live link but the one they came from (called with the lock held)"""
+        # Encoded once per codec in use; the links share the bytes
+        packet = Packet({"type": "peer_messages", "messages": messages})
+        for link in self.links:
+            if link is not exclude:
+                link.send(packet)
+
+    def dial(self, host, port):
+        """Keep a link to a configured peer open until stopped"""
+        while self.running:
+            try:
+                self.run_link(host, port)
+            except OSError as e:
+                logger.warning("Cannot reach peer %s:%s: %s", host, port, e)
+            except Exception as e:
+                logger.error("Error on link to peer %s:%s: %s", host, port, e)
+            self.stopping.wait(RECONNECT_DELAY)
+
+    def run_link(self, host, port):
+        """Open one outgoing link and relay over it until it closes"""
+        peer_socket = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        peer_socket.settimeout(None)
+        decoder = FrameDecoder()
+        outbox = ThreadedOutbox(PEER_QUEUE_FRAMES, "disconnect", PEER_QUEUE_BYTES, metrics=self.server.metrics)
+        writer_thread = outbox.start_writer(peer_socket)
+        link = None
+
+        try:
+            outbox.put(self.hello())
+            while self.running:
+                data = peer_socket.recv(65536)
+                if not data:
+                    break
+
+                for frame in decoder.feed(data):
+                    packet = decode_packet(frame)
+                    if link:
+                        self.receive(link, packet)
+                        continue
+
+                    # The first reply is a welcome or the reason the link was refused
+                    node = packet.get("node")
+                    if packet.get("type") != "peer_welcome" or not isinstance(node, str) or node == self.node:
+                        logger.error("Peer %s:%s refused the link: %s", host, port, packet.get("message"))
+                        return
+                    outbox.codec = codec_for(packet.get("capabilities") or ())
+                    link = PeerLink(node, outbox)
+                    link.socket = peer_socket
+                    if not self.sync(link, packet.get("watermarks")):
+                        return
+        finally:
+            if link:
+                self.drop(link)
+            outbox.close()
+            writer_thread.join(timeout=5)
+            peer_socket.close()
+
+def parse_peer(address):
+    """Split a host:port peer address"""
+    host, separator, port = address.strip().rpartition(":")
+    if not separator or not host or not port.isdigit():
+        raise ValueError(f"Peer address must be host:port, not {address!r}")
+    return host, int(port)
+
+def valid_wire_message(message):
+    """Check the shape of a message relayed by a peer"""
+    return (
+        isinstance(message, dict)
+        and isinstance(message.get("origin"), str)
+        and type(message.get("origin_id")) is int
+        and validate_room_name(message.get("room"))
+        and isinstance(message.get("username"), str)
+        and isinstance(message.get("timestamp"), str)
+        and isinstance(message.get("content"), str)
+        and bool(message["content"])
+    )
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import argparse
+import configparser
+import logging
+import os
+import signal
+import sys
+import time
+from message_writer import DURABILITY_MODES
+from outbox import OVERFLOW_POLICIES
+from server import ENGINES, create_server
+from server_log import start_background_logging
+
+ENV_PREFIX = "FORUM_"
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+logger = logging.getLogger(__name__)
+
+def build_parser():
+    """Create the command line parser for the headless server"""
+    parser = argparse.ArgumentParser(description="Run the LAN forum server without a GUI")
+    parser.add_argument("--config", help=f"INI file with a [server] section (env: {ENV_PREFIX}CONFIG)")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=5555, help="port to listen on")
+    parser.add_argument("--db", default="forum.db", help="path of the SQLite database")
+    parser.add_argument("--backlog", type=int, default=128, help="pending connections the listening socket queues")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded", help="connection handling engine")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port (needs SO_REUSEPORT)")
+    parser.add_argument("--outbox-size", type=int, default=1024, help="frames queued per client before the overflow policy applies")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default="drop_oldest", help="what to do when a client falls behind")
+    parser.add_argument("--persistence", choices=DURABILITY_MODES, default="batched", help="how chat messages are written to the database")
+    parser.add_argument("--auth-processes", type=int, default=2, help="bcrypt worker processes (0 verifies on the connection thread)")
+    parser.add_argument("--retention-days", type=float, help="archive messages older than this many days")
+    parser.add_argument("--retention-rows", type=int, help="archive all but the newest this many messages of each room")
+    parser.add_argument("--archive-dir", default="archive", help="directory for archived message segments")
+    parser.add_argument("--node", help="name of this server among its peers, stable across restarts (default: hostname:port)")
+    parser.add_argument("--peers", default="", help="comma-separated host:port list of forum servers to peer with")
+    parser.add_argument("--peer-secret", help="shared secret peers present; peering is off without it")
+    parser.add_argument("--log-file", help="also write the log to this file, rotated at 10 MB")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO", help="lowest level of log records to keep")
+    return parser
+
+def config_file_args(path):
+    """Turn the [server] section of a config file into command line arguments"""
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise SystemExit(f"Cannot read config file: {path}")
+
+    args = []
+    if config.has_section("server"):
+        for key, value in config.items("server"):
+            args.extend([f"--{key.replace('_', '-')}", value])
+    return args
+
+def environment_args(parser, environ):
+    """Turn FORUM_* environment variables into command line arguments"""
+    args = []
+    for action in parser._actions:
+        name = ENV_PREFIX + action.dest.upper()
+        if action.option_strings and action.dest not in ("help", "config") and name in environ:
+            args.extend([action.option_strings[0], environ[name]])
+    return args
+
+def parse_args(argv=None, environ=None):
+    """Parse options from the config file, environment and command line"""
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    environ = os.environ if environ is None else environ
+
+    # Later arguments win, so layering the sources as one argument list gives
+    # them their priority and runs every value through the same validation
+    known, _ = parser.parse_known_args(argv)
+    config_path = known.config or environ.get(ENV_PREFIX + "CONFIG")
+    layered = config_file_args(config_path) if config_path else []
+    layered += environment_args(parser, environ)
+    return parser.parse_args(layered + argv)
+
+def main(argv=None):
+    """Start the server and keep it running until interrupted"""
+    args = parse_args(argv)
+
+    # Log records are written to stdout (the journal under systemd) and the
+    # optional file by a listener thread
+    listener = start_background_logging(args.log_file, getattr(logging, args.log_level))
+
+    # systemctl stop sends SIGTERM; unwind through server.stop() so queued messages are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server = create_server(
+            args.engine, args.host, args.port,
+            workers=args.workers,
+            node=args.node,
+            peers=[peer for peer in args.peers.split(",") if peer.strip()],
+            peer_secret=args.peer_secret,
+            db_file=args.db,
+            backlog=args.backlog,
+            outbox_size=args.outbox_size,
+            overflow_policy=args.overflow_policy,
+            persistence=args.persistence,
+            auth_processes=args.auth_processes,
+            retention_days=args.retention_days,
+            retention_rows=args.retention_rows,
+            archive_dir=args.archive_dir
+        )
+    except ValueError as e:
+        logger.error("Invalid configuration: %s", e)
+        listener.stop()
+        return 1
+    
+    try:
+        if not server.start():
+            return 1
+
+        while server.running:
+            time.sleep(1)
+    except OSError as e:
+        logger.error("Error starting server: %s", e)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        listener.stop()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
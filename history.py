@@ -0,0 +1,47 @@
+import threading
+from collections import deque
+from protocol import DEFAULT_ROOM, Packet
+
+class HistoryCache:
+    """Bounded ring of recent messages with a shared history packet"""
+
+    def __init__(self, size=100, room=DEFAULT_ROOM):
+        """Initialize an empty ring holding at most size messages of a room"""
+        self.room = room
+        self.messages = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.packet = None
+
+    def warm(self, messages):
+        """Fill the ring from stored messages, oldest first, below any appended since it was created"""
+        with self.lock:
+            newer = list(self.messages)
+            if newer:
+                messages = [m for m in messages if m["id"] < newer[0]["id"]]
+            self.messages.clear()
+            self.messages.extend(messages + newer)
+            self.packet = None
+
+    def append(self, message):
+        """Add a new message, evicting the oldest once the ring is full"""
+        with self.lock:
+            self.messages.append(message)
+            self.packet = None
+
+    def snapshot(self):
+        """Return the cached messages, oldest first"""
+        with self.lock:
+            return list(self.messages)
+
+    def history_packet(self):
+        """Return the message_history packet, rebuilding it only after changes"""
+        # Logins between two chat messages all share the same packet, which is
+        # encoded once per codec in use
+        with self.lock:
+            if self.packet is None:
+                self.packet = Packet({
+                    "type": "message_history",
+                    "room": self.room,
+                    "messages": list(self.messages)
+                })
+            return self.packet
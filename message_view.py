@@ -0,0 +1,269 @@
+import tkinter as tk
+from tkinter import scrolledtext
+from protocol import DEFAULT_ROOM
+
+# The Text widget only ever holds RENDER_WINDOW messages; scrolling past either
+# edge slides that window WINDOW_STEP messages through the record list
+RENDER_WINDOW = 400
+WINDOW_STEP = 100
+
+# Records kept in memory; older ones are dropped and fetched from the server again on demand
+MAX_RECORDS = 20000
+
+def format_message(username, content, timestamp, system=False, room=DEFAULT_ROOM):
+    """Return the (text, tag) pieces that display one message"""
+    # Timestamps are "YYYY-MM-DD HH:MM:SS"; show just the time
+    time_str = timestamp[11:19] if isinstance(timestamp, str) and len(timestamp) >= 19 else timestamp
+
+    # Add the message with formatting; rooms other than the default are labelled
+    pieces = [(f"[{time_str}] ", "time")]
+    if room != DEFAULT_ROOM:
+        pieces.append((f"#{room} ", "room"))
+
+    if system:
+        pieces.append((f"{content}\n", "system"))
+    else:
+        pieces.append((f"{username}: ", "username"))
+        pieces.append((f"{content}\n", "message"))
+    return pieces
+
+class MessageRecord:
+    """One message held by the view"""
+    __slots__ = ("message_id", "room", "username", "content", "timestamp", "kind")
+
+    def __init__(self, message_id, room, username, content, timestamp, kind="message"):
+        """Initialize a record; kind is "message", "system" or "direct" """
+        self.message_id = message_id
+        self.room = room
+        self.username = username
+        self.content = content
+        self.timestamp = timestamp
+        self.kind = kind
+
+    def pieces(self):
+        """Return the (text, tag) pieces that display this record"""
+        pieces = format_message(self.username, self.content, self.timestamp, self.kind == "system", self.room or DEFAULT_ROOM)
+        if self.kind == "direct":
+            pieces = [(text, "direct" if tag == "username" else tag) for text, tag in pieces]
+        return pieces
+
+    def line_count(self):
+        """Return the number of text lines the record takes up"""
+        return self.content.count("\n") + 1 if isinstance(self.content, str) else 1
+
+def render(records):
+    """Flatten records into text, tag arguments for a single Text.insert"""
+    args = []
+    for record in records:
+        for piece in record.pieces():
+            args.extend(piece)
+    return args
+
+def line_count(records):
+    """Return the number of text lines a run of records takes up"""
+    return sum(record.line_count() for record in records)
+
+class MessageView:
+    """Scrollable message list that renders only a window of its records"""
+
+    def __init__(self, parent, on_reach_top=None, on_trim=None):
+        """Create the text widget; on_reach_top asks for older messages, on_trim(room, before_id) reports dropped ones"""
+        self.on_reach_top = on_reach_top
+        self.on_trim = on_trim
+
+        # records[start:end] is what the Text widget currently shows
+        self.records = []
+        self.start = 0
+        self.end = 0
+        self.check_pending = False
+
+        self.text = scrolledtext.ScrolledText(parent, wrap=tk.WORD)
+        self.text.config(state=tk.DISABLED, yscrollcommand=self.on_scroll)
+        self.configure_tags()
+
+    def configure_tags(self):
+        """Configure the text tags used for messages"""
+        self.text.tag_configure("time", foreground="gray")
+        self.text.tag_configure("username", foreground="blue", font=("Helvetica", 10, "bold"))
+        self.text.tag_configure("message", foreground="black")
+        self.text.tag_configure("system", foreground="green", font=("Helvetica", 10, "italic"))
+        self.text.tag_configure("room", foreground="purple")
+        self.text.tag_configure("direct", foreground="dark orange", font=("Helvetica", 10, "bold"))
+
+    def pack(self, **options):
+        """Pack the text widget"""
+        self.text.pack(**options)
+
+    def pack_forget(self):
+        """Unpack the text widget"""
+        self.text.pack_forget()
+
+    def destroy(self):
+        """Destroy the text widget"""
+        self.text.destroy()
+
+    def top_line(self):
+        """Return the widget line at the top of the visible area"""
+        return int(self.text.index("@0,0").split(".")[0])
+
+    def append(self, records):
+        """Add new messages at the bottom, drawing them if the window is at the tail"""
+        if not records:
+            return
+
+        at_tail = self.end == len(self.records)
+        self.records.extend(records)
+        if not at_tail:
+            # The user is reading older messages; these are drawn when they scroll
+            # down, but the list is still kept within its limit meanwhile
+            self.trim_records()
+            return
+
+        # Follow new messages only if the user was already at the bottom
+        at_bottom = self.text.yview()[1] >= 1.0
+
+        self.text.config(state=tk.NORMAL)
+        self.text.insert(tk.END, *render(records))
+        self.end = len(self.records)
+        self.shrink_window(from_top=True)
+        if at_bottom:
+            self.text.see(tk.END)
+        self.text.config(state=tk.DISABLED)
+
+        self.trim_records()
+
+    def prepend(self, records):
+        """Add a page of older messages above the current ones"""
+        if not records:
+            return
+
+        self.records[0:0] = records
+        if self.start > 0:
+            # Not visible yet; the window just moves down with the indices
+            self.start += len(records)
+            self.end += len(records)
+            return
+
+        # The window is at the top, so the page is drawn where the user is looking
+        self.text.config(state=tk.NORMAL)
+        top_line = self.top_line()
+        self.text.insert("1.0", *render(records))
+        self.end += len(records)
+        self.shrink_window(from_top=False)
+
+        # Keep the line the user was looking at in place
+        self.text.yview(f"{top_line + line_count(records)}.0")
+        self.text.config(state=tk.DISABLED)
+
+    def clear(self):
+        """Forget every record and empty the widget"""
+        self.records = []
+        self.start = 0
+        self.end = 0
+        self.text.config(state=tk.NORMAL)
+        self.text.delete("1.0", tk.END)
+        self.text.config(state=tk.DISABLED)
+
+    def shrink_window(self, from_top):
+        """Remove records from one edge of the widget until it holds RENDER_WINDOW"""
+        excess = (self.end - self.start) - RENDER_WINDOW
+        if excess <= 0:
+            return
+
+        if from_top:
+            lines = line_count(self.records[self.start:self.start + excess])
+            top_line = self.top_line()
+            self.text.delete("1.0", f"{lines + 1}.0")
+            self.text.yview(f"{max(1, top_line - lines)}.0")
+            self.start += excess
+        else:
+            lines = line_count(self.records[self.end - excess:self.end])
+            last_line = int(self.text.index("end-1c").split(".")[0])
+            self.text.delete(f"{last_line - lines}.0", tk.END)
+            self.end -= excess
+
+    def on_scroll(self, first, last):
+        """Update the scrollbar and slide the window when an edge comes into view"""
+        self.text.vbar.set(first, last)
+
+        # The window is moved after Tk finishes the current redraw
+        if not self.check_pending:
+            self.check_pending = True
+            self.text.after_idle(self.check_window)
+
+    def check_window(self):
+        """Slide the window, or ask for older messages, if the view is at an edge"""
+        self.check_pending = False
+        first, last = self.text.yview()
+
+        # Only when the text overflows, otherwise every insert would look like an edge
+        if first <= 0.0 and last < 1.0:
+            if self.start > 0:
+                self.slide_up()
+            elif self.on_reach_top:
+                self.on_reach_top()
+        elif last >= 1.0 and first > 0.0 and self.end < len(self.records):
+            self.slide_down()
+
+    def slide_up(self):
+        """Draw the WINDOW_STEP records above the window and drop as many from the bottom"""
+        step = min(WINDOW_STEP, self.start)
+        records = self.records[self.start - step:self.start]
+
+        self.text.config(state=tk.NORMAL)
+        top_line = self.top_line()
+        self.text.insert("1.0", *render(records))
+        self.start -= step
+        self.shrink_window(from_top=False)
+        self.text.yview(f"{top_line + line_count(records)}.0")
+        self.text.config(state=tk.DISABLED)
+
+    def slide_down(self):
+        """Draw the WINDOW_STEP records below the window and drop as many from the top"""
+        step = min(WINDOW_STEP, len(self.records) - self.end)
+        records = self.records[self.end:self.end + step]
+
+        self.text.config(state=tk.NORMAL)
+        self.text.insert(tk.END, *render(records))
+        self.end += step
+        self.shrink_window(from_top=True)
+        self.text.config(state=tk.DISABLED)
+
+    def trim_records(self):
+        """Drop the oldest records once there are more than MAX_RECORDS"""
+        excess = len(self.records) - MAX_RECORDS
+        if excess <= 0:
+            return
+
+        # Drop a tenth more than needed so this runs once per MAX_RECORDS // 10 messages,
+        # but never anything inside the window unless the list is twice the limit
+        count = min(excess + MAX_RECORDS // 10, self.start)
+        if count < excess and len(self.records) < 2 * MAX_RECORDS:
+            return
+
+        if count < excess:
+            # Someone has sat far up in the history for a long time: jump to the tail
+            count = excess + MAX_RECORDS // 10
+            dropped = self.records[:count]
+            del self.records[:count]
+            self.end = len(self.records)
+            self.start = max(0, self.end - RENDER_WINDOW)
+            self.text.config(state=tk.NORMAL)
+            self.text.delete("1.0", tk.END)
+            self.text.insert(tk.END, *render(self.records[self.start:self.end]))
+            self.text.see(tk.END)
+            self.text.config(state=tk.DISABLED)
+        else:
+            dropped = self.records[:count]
+            del self.records[:count]
+            self.start -= count
+            self.end -= count
+
+        # Scrolling back up past the remaining records fetches the dropped ones again
+        if self.on_trim:
+            newest = {}
+            for record in dropped:
+                if record.kind != "direct" and record.message_id is not None:
+                    newest[record.room] = max(newest.get(record.room, 0), record.message_id)
+            for room, message_id in newest.items():
+                self.on_trim(room, message_id + 1)
@@ -0,0 +1,160 @@
+import logging
+import sqlite3
+import threading
+import itertools
+import queue
+import time
+from protocol import DEFAULT_ROOM
+
+logger = logging.getLogger(__name__)
+
+# How chat messages reach the database:
+#   sync    - written before the broadcast, one transaction per message
+#   batched - queued and group-committed by a background thread
+#   memory  - never written; history lives only as long as the process
+DURABILITY_MODES = ("sync", "batched", "memory")
+
+# Seconds to wait before each retry of a batch the database refused, usually
+# because another connection held the write lock. Its messages have already
+# been broadcast, so the batch is only given up after the last retry
+WRITE_RETRY_DELAYS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+class MessageWriter:
+    """Assigns message ids and persists messages off the broadcast path"""
+
+    def __init__(self, db, mode="batched", batch_size=200, flush_interval=0.05, max_queue=10000):
+        """Initialize the writer for a database and durability mode"""
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {mode}")
+
+        self.db = db
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+
+        # Ids are handed out here so batched and in-memory messages still get
+        # a stable id before they reach the database
+        self.last_id = db.get_last_message_id()
+        self.ids = itertools.count(self.last_id + 1)
+        self.last_direct_id = db.get_last_direct_message_id()
+        self.direct_ids = itertools.count(self.last_direct_id + 1)
+
+    def start(self):
+        """Start the background flush thread in batched mode"""
+        if self.mode == "batched" and not self.thread:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Flush everything still queued and stop the background thread"""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def save(self, username, content, timestamp, room=DEFAULT_ROOM, origin=None, origin_id=None):
+        """Number a message, persist it according to the durability mode and return it"""
+        message = {
+            "id": next(self.ids),
+            "room": room,
+            "username": username,
+            "timestamp": timestamp,
+            "content": content
+        }
+        self.store(message, origin, origin_id)
+        return message
+
+    def store(self, message, origin=None, origin_id=None):
+        """Persist a message that already has its id, with its peer node origin if relayed"""
+        # Worker processes get their ids from the cluster hub instead of self.ids;
+        # last_id only moves forward, whatever order callers store in
+        if message["id"] > self.last_id:
+            self.last_id = message["id"]
+        row = (message["id"], message["room"], message["username"], message["timestamp"], message["content"], origin, origin_id)
+
+        if self.mode == "sync":
+            self.db.save_messages([row])
+        elif self.mode == "batched":
+            # Blocks only when the writer has fallen max_queue messages behind
+            self.queue.put(row)
+
+    def save_direct(self, sender, recipient, content, timestamp):
+        """Number a direct message, persist it and return it"""
+        message = {
+            "id": next(self.direct_ids),
+            "sender": sender,
+            "recipient": recipient,
+            "timestamp": timestamp,
+            "content": content
+        }
+        self.store_direct(message)
+        return message
+
+    def store_direct(self, message):
+        """Persist a direct message that already has its id"""
+        if message["id"] > self.last_direct_id:
+            self.last_direct_id = message["id"]
+
+        # Direct messages are written straight away in both sync and batched mode:
+        # there is no ring in front of them, so the recipient's next sync reads
+        # them from the database and must not miss one still sitting in the queue
+        if self.mode != "memory":
+            self.db.save_direct_message(message["id"], message["sender"], message["recipient"], message["timestamp"], message["content"])
+
+    def flush(self):
+        """Block until every queued message has been committed"""
+        if self.thread:
+            self.queue.join()
+
+    def run(self):
+        """Collect queued messages and commit them in batches"""
+        # A batch closes when it is full or flush_interval after its first message
+        while True:
+            row = self.queue.get()
+            if row is None:
+                self.queue.task_done()
+                break
+
+            batch = [row]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    row = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+
+            self.write_batch(batch)
+            for _ in range(len(batch) + stopping):
+                self.queue.task_done()
+
+            if stopping:
+                break
+
+    def write_batch(self, batch):
+        """Commit one batch of messages in a single transaction, retrying while the database is busy"""
+        for delay in WRITE_RETRY_DELAYS + (None,):
+            try:
+                self.db.save_messages(batch)
+                return True
+            except sqlite3.OperationalError as e:
+                if delay is None:
+                    error = e
+                    break
+                logger.warning("Could not save %d messages, retrying in %s s: %s", len(batch), delay, e)
+                time.sleep(delay)
+            except Exception as e:
+                # Waiting does not help with anything but a busy or locked database
+                error = e
+                break
+
+        logger.error("Lost messages %d to %d, which could not be saved: %s", batch[0][0], batch[-1][0], error)
+        return False
@@ -0,0 +1,137 @@
+import time
+import bisect
+import functools
+import threading
+
+# Histogram bucket upper bounds in seconds: 10 µs doubling up to about 40 s
+BUCKETS = tuple(0.00001 * 2 ** i for i in range(23))
+
+class Histogram:
+    """Latency histogram with fixed, doubling buckets"""
+    __slots__ = ("counts", "count", "total", "max", "lock")
+
+    def __init__(self):
+        """Initialize an empty histogram"""
+        # One extra bucket catches everything slower than the last bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Record one duration"""
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        """Estimate the duration below which the given fraction of observations fall"""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            largest = self.max
+        if not count:
+            return None
+
+        # Interpolate inside the bucket that holds the target rank
+        target = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= target:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else largest
+                return min(largest, lower + (upper - lower) * (target - seen) / bucket_count)
+            seen += bucket_count
+        return largest
+
+    def summary(self):
+        """Return count, mean, p50, p99 and max, in milliseconds"""
+        count = self.count
+        return {
+            "count": count,
+            "mean_ms": round(self.total / count * 1000, 3) if count else None,
+            "p50_ms": round(self.percentile(0.50) * 1000, 3) if count else None,
+            "p99_ms": round(self.percentile(0.99) * 1000, 3) if count else None,
+            "max_ms": round(self.max * 1000, 3) if count else None
+        }
+
+class Metrics:
+    """Named counters and latency histograms shared by the server's threads"""
+
+    def __init__(self):
+        """Initialize an empty registry"""
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def add(self, name, amount=1):
+        """Increase a counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        """Return a histogram, creating it on first use"""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        """Record a duration in a histogram"""
+        self.histogram(name).observe(seconds)
+
+    def instrument(self, obj, prefix, exclude=()):
+        """Time every public method of an object under prefix.method_name"""
+        # Wraps the bound methods on the instance, so other holders of obj are
+        # measured too, and the class itself is left alone
+        for name in dir(type(obj)):
+            if name.startswith("_") or name in exclude:
+                continue
+            attribute = getattr(type(obj), name)
+            if callable(attribute) and not isinstance(attribute, (type, staticmethod, classmethod)):
+                setattr(obj, name, self.wrap(getattr(obj, name), f"{prefix}.{name}"))
+
+    def wrap(self, function, name):
+        """Return function with its duration recorded under name"""
+        histogram = self.histogram(name)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+
+    def snapshot(self):
+        """Return uptime, counters and histogram summaries as plain data"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+
+        return {
+            "uptime": round(time.monotonic() - self.started, 3),
+            "counters": counters,
+            "histograms": {name: histogram.summary() for name, histogram in sorted(histograms.items()) if histogram.count}
+        }
+
+def timed(name):
+    """Decorate a method to record its duration in self.metrics under name"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,208 @@
+import threading
+import asyncio
+import socket
+from collections import deque
+from protocol import JSON_CODEC
+
+# What to do when a client's queue is full:
+#   drop_oldest - discard the oldest queued frame to make room
+#   disconnect  - give up on the client and close its connection
+#   coalesce    - merge everything queued into one buffer, up to max_bytes
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect", "coalesce")
+
+class Outbox:
+    """Bounded queue of outgoing frames for a single connection"""
+
+    def __init__(self, max_frames=1024, policy="drop_oldest", max_bytes=4 * 1024 * 1024, metrics=None):
+        """Initialize an empty outbox with the given overflow policy and optional server metrics"""
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+
+        self.max_frames = max_frames
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.aborted = False
+        self.dropped = 0
+        self.metrics = metrics
+        
+        # Every connection speaks JSON until login negotiates something else
+        self.codec = JSON_CODEC
+
+    def put(self, frame):
+        """Queue a packet dict, shared Packet or ready frame, returning False if the client is gone"""
+        # Packets are encoded here, in the connection's codec, before taking the lock;
+        # never blocks, so a slow receiver cannot stall the caller
+        if not isinstance(frame, bytes):
+            frame = self.codec.frame(frame)
+        with self.lock:
+            if self.closed:
+                return False
+
+            if len(self.frames) >= self.max_frames and not self.make_room():
+                if self.metrics:
+                    self.metrics.add("outbox.disconnects")
+                self.abort()
+                return False
+
+            self.frames.append(frame)
+            self.wake()
+        return True
+
+    def make_room(self):
+        """Apply the overflow policy, returning False if the client must be dropped"""
+        if self.policy == "drop_oldest":
+            self.frames.popleft()
+            self.dropped += 1
+            if self.metrics:
+                self.metrics.add("outbox.dropped")
+            return True
+
+        if self.policy == "coalesce":
+            merged = b"".join(self.frames)
+            if len(merged) > self.max_bytes:
+                return False
+            self.frames.clear()
+            self.frames.append(merged)
+            return True
+
+        return False
+
+    def sent(self, data):
+        """Count bytes handed to the transport"""
+        if self.metrics:
+            self.metrics.add("bytes.out", len(data))
+
+    def take_all(self):
+        """Remove and return every queued frame"""
+        with self.lock:
+            batch = list(self.frames)
+            self.frames.clear()
+        return batch
+
+    def close(self, abort=False):
+        """Stop accepting frames; already queued frames are still sent unless aborted"""
+        with self.lock:
+            if abort:
+                self.abort()
+            else:
+                self.closed = True
+                self.wake()
+
+    def abort(self):
+        """Discard queued frames and drop the connection (called with the lock held)"""
+        if self.aborted:
+            return
+        self.closed = True
+        self.aborted = True
+        self.frames.clear()
+        self.wake()
+        self.abort_transport()
+
+    def wake(self):
+        """Notify the writer that frames are ready (called with the lock held)"""
+        pass
+
+    def abort_transport(self):
+        """Forcibly close the underlying connection (called with the lock held)"""
+        pass
+
+class ThreadedOutbox(Outbox):
+    """Outbox drained by a dedicated writer thread"""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the outbox and its wake-up condition"""
+        super().__init__(*args, **kwargs)
+        self.ready = threading.Condition(self.lock)
+        self.client_socket = None
+
+    def wake(self):
+        """Wake the writer thread"""
+        self.ready.notify()
+
+    def abort_transport(self):
+        """Shut the socket down, unblocking both the writer and the reader thread"""
+        if self.client_socket:
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait_batch(self):
+        """Block until frames are queued, returning None once closed and empty"""
+        with self.ready:
+            while not self.frames and not self.closed:
+                self.ready.wait()
+            batch = list(self.frames)
+            self.frames.clear()
+        return batch or None
+
+    def run_writer(self, client_socket):
+        """Send queued frames until the outbox is closed"""
+        # Everything queued since the last wake-up goes out in one sendall
+        try:
+            while True:
+                batch = self.wait_batch()
+                if batch is None:
+                    break
+                data = batch[0] if len(batch) == 1 else b"".join(batch)
+                client_socket.sendall(data)
+                self.sent(data)
+        except OSError:
+            self.close(abort=True)
+
+    def start_writer(self, client_socket):
+        """Start the writer thread for a socket"""
+        self.client_socket = client_socket
+        writer_thread = threading.Thread(target=self.run_writer, args=(client_socket,))
+        writer_thread.daemon = True
+        writer_thread.start()
+        return writer_thread
+
+class AsyncOutbox(Outbox):
+    """Outbox drained by a writer task on an asyncio event loop"""
+
+    def __init__(self, loop, *args, **kwargs):
+        """Initialize the outbox for a given event loop"""
+        super().__init__(*args, **kwargs)
+        self.loop = loop
+        self.ready = asyncio.Event()
+        self.waiting = False
+        self.transport = None
+
+    def wake(self):
+        """Wake the writer task, crossing threads only when it is idle"""
+        if self.waiting:
+            self.waiting = False
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def abort_transport(self):
+        """Abort the transport from the event loop thread"""
+        if self.transport:
+            self.loop.call_soon_threadsafe(self.transport.abort)
+
+    async def run_writer(self, writer):
+        """Write queued frames to a stream until the outbox is closed"""
+        self.transport = writer.transport
+        try:
+            while True:
+                batch = self.take_all()
+                if batch:
+                    data = batch[0] if len(batch) == 1 else b"".join(batch)
+                    writer.write(data)
+                    self.sent(data)
+                    await writer.drain()
+                    continue
+
+                with self.lock:
+                    if self.closed and not self.frames:
+                        break
+                    if self.frames:
+                        continue
+                    self.ready.clear()
+                    self.waiting = True
+                await self.ready.wait()
+        except (ConnectionError, OSError):
+            self.close(abort=True)
@@ -0,0 +1,322 @@
+import json
+import time
+import zlib
+import struct
+import calendar
+import functools
+import itertools
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Every packet on the wire is a 4-byte big-endian length followed by a body:
+# UTF-8 JSON, or MessagePack once both sides have negotiated the compact codec.
+# The top bit of the length marks a deflate-compressed body
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+COMPRESSED_FLAG = 0x80000000
+LENGTH_MASK = 0x7FFFFFFF
+
+# Bodies smaller than this go out uncompressed, so chat lines pay no extra latency
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+
+# Every compressed body starts from this dictionary, so even the first history
+# batch on a connection compresses its repeated keys. Frames are compressed one
+# at a time rather than as a stream, which lets shared frames be cached; the
+# dictionary is part of the wire format and must never change
+PRESET_DICTIONARY = (
+    b'{"type": "search_results", "query": "offset": 0, "has_more": false, true, '
+    b'"before_id": "since_id": "history_page", "direct_history", "sender": "recipient": '
+    b'{"type": "message_history", "room": "general", "messages": [{"id": 1, "room": "general", '
+    b'"username": "", "timestamp": "2026-01-01 00:00:00", "content": "", "system": false}, '
+    b'{"id": 1, "room": "general", "username": "", "timestamp": "2026-01-01 00:00:00", "content": "'
+)
+
+# Room every client joins at login
+DEFAULT_ROOM = "general"
+
+# Capabilities a client may offer in its login packet; the compact codec
+# is only offered where msgpack is installed
+FRAMING_CAPABILITY = "length-prefix"
+COMPACT_CAPABILITY = "msgpack"
+COMPRESSION_CAPABILITY = "deflate"
+SERVER_CAPABILITIES = (FRAMING_CAPABILITY, COMPRESSION_CAPABILITY) + ((COMPACT_CAPABILITY,) if msgpack else ())
+CLIENT_CAPABILITIES = SERVER_CAPABILITIES
+
+# Compact packets replace these type names and field names with their index.
+# Both lists are part of the wire format: only ever append to them
+PACKET_TYPES = (
+    "login", "login_response", "message", "message_history", "history_reset",
+    "history_before", "history_page", "search", "search_results", "direct_message",
+    "direct_history", "join_room", "leave_room", "room_joined", "room_left", "error", "stats",
+    "peer_hello", "peer_welcome", "peer_messages"
+)
+FIELDS = (
+    "type", "id", "room", "username", "timestamp", "content", "system", "messages",
+    "since_id", "before_id", "has_more", "limit", "offset", "query", "sender", "recipient",
+    "to", "message", "success", "last_seen_id", "last_dm_id", "role", "capabilities", "token",
+    "node", "secret", "watermarks", "origin", "origin_id"
+)
+TYPE_TAGS = {name: tag for tag, name in enumerate(PACKET_TYPES)}
+FIELD_TAGS = {name: tag for tag, name in enumerate(FIELDS)}
+TYPE_FIELD = FIELD_TAGS["type"]
+TIMESTAMP_FIELD = FIELD_TAGS["timestamp"]
+MESSAGES_FIELD = FIELD_TAGS["messages"]
+ID_FIELD = FIELD_TAGS["id"]
+
+class ProtocolError(Exception):
+    """Raised when a peer sends data that does not follow the wire protocol"""
+    pass
+
+def encode_frame(payload, compressed=False):
+    """Prefix a payload with its length, flagged if the payload is compressed"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return HEADER.pack(len(payload) | COMPRESSED_FLAG if compressed else len(payload)) + payload
+
+def deflate(body):
+    """Compress a frame body against the preset dictionary"""
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=PRESET_DICTIONARY)
+    return compressor.compress(body) + compressor.flush()
+
+def inflate(payload, max_size=MAX_FRAME_SIZE):
+    """Decompress a frame body, refusing to expand it beyond max_size"""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=PRESET_DICTIONARY)
+    try:
+        body = decompressor.decompress(payload, max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"Invalid compressed frame: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"Compressed frame expands beyond the {max_size} byte limit")
+    return body
+
+def encode_packet(packet):
+    """Serialize a packet dict into a complete JSON frame"""
+    return encode_frame(json.dumps(packet).encode('utf-8'))
+
+def decode_packet(frame):
+    """Deserialize a frame body back into a packet dict, whichever codec produced it"""
+    # JSON bodies are objects and start with '{'; compact bodies are MessagePack maps
+    if frame[:1] == b"{":
+        return json.loads(frame.decode('utf-8'))
+    if msgpack is None:
+        raise ProtocolError("Received a compact frame but msgpack is not installed")
+    return expand_packet(msgpack.unpackb(frame, strict_map_key=False))
+
+# The history ring is re-encoded after every chat message with 99 of the same
+# timestamps, so conversions are cached
+@functools.lru_cache(maxsize=4096)
+def pack_timestamp(value):
+    """Turn a "YYYY-MM-DD HH:MM:SS" timestamp into integer seconds, or return it unchanged"""
+    # The server's timestamps are naive wall-clock times, so they are counted as
+    # if they were UTC. timegm rolls invalid dates over ("02-30" becomes "03-02"),
+    # so only values that unpack to exactly the same string are packed
+    if isinstance(value, str) and len(value) == 19 and value[4] == "-" and value[10] == " ":
+        try:
+            packed = calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                      int(value[11:13]), int(value[14:16]), int(value[17:19])))
+        except ValueError:
+            return value
+        if unpack_timestamp(packed) == value:
+            return packed
+    return value
+
+@functools.lru_cache(maxsize=4096)
+def unpack_timestamp(value):
+    """Turn integer seconds from pack_timestamp back into a timestamp string"""
+    if isinstance(value, int):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(value))
+    return value
+
+def compact_packet(packet):
+    """Convert a packet dict into its compact form, ready for MessagePack"""
+    compact = {}
+    for key, value in packet.items():
+        tag = FIELD_TAGS.get(key, key)
+        if tag == TYPE_FIELD:
+            value = TYPE_TAGS.get(value, value)
+        elif tag == TIMESTAMP_FIELD:
+            value = pack_timestamp(value)
+        elif tag == MESSAGES_FIELD and isinstance(value, list):
+            value = compact_messages(value)
+        compact[tag] = value
+    return compact
+
+def expand_packet(compact):
+    """Convert a compact packet back into the packet dict it was made from"""
+    packet = {}
+    for tag, value in compact.items():
+        if tag == TYPE_FIELD:
+            value = PACKET_TYPES[value] if isinstance(value, int) else value
+        elif tag == TIMESTAMP_FIELD:
+            value = unpack_timestamp(value)
+        elif tag == MESSAGES_FIELD:
+            value = expand_messages(value)
+        packet[FIELDS[tag] if isinstance(tag, int) else tag] = value
+    return packet
+
+def compact_messages(messages):
+    """Store a list of messages column by column, ids as differences"""
+    # Rows of a history batch share their keys, so each key is sent once; a
+    # mixed list is sent row by row instead
+    if not messages or not all(isinstance(m, dict) for m in messages):
+        return messages
+    keys = list(messages[0])
+    if any(list(m) != keys for m in messages):
+        return [compact_packet(m) for m in messages]
+
+    columns = {}
+    for key in keys:
+        tag = FIELD_TAGS.get(key, key)
+        values = [m[key] for m in messages]
+        if tag == TIMESTAMP_FIELD:
+            values = [pack_timestamp(v) for v in values]
+        elif tag == ID_FIELD and all(isinstance(v, int) for v in values):
+            values = [values[0]] + [b - a for a, b in zip(values, values[1:])]
+        columns[tag] = values
+    return columns
+
+def expand_messages(value):
+    """Turn compact messages, columnar or row by row, back into a list of dicts"""
+    if isinstance(value, list):
+        return [expand_packet(m) if isinstance(m, dict) else m for m in value]
+
+    names = []
+    columns = []
+    for tag, values in value.items():
+        if tag == TIMESTAMP_FIELD:
+            values = [unpack_timestamp(v) for v in values]
+        elif tag == ID_FIELD:
+            values = list(itertools.accumulate(values))
+        names.append(FIELDS[tag] if isinstance(tag, int) else tag)
+        columns.append(values)
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+class Packet:
+    """A packet shared by many connections, encoded at most once per codec"""
+    __slots__ = ("data", "frames")
+
+    def __init__(self, data):
+        """Initialize with the packet dict"""
+        self.data = data
+        self.frames = {}
+
+    def frame(self, codec):
+        """Return the frame for a codec, encoding it on first use"""
+        # Two threads may encode the same codec at once; both produce the same bytes
+        frame = self.frames.get(codec.name)
+        if frame is None:
+            frame = self.frames[codec.name] = codec.encode(self.data)
+        return frame
+
+class JsonCodec:
+    """Encodes packets as JSON, the format every client understands"""
+    name = "json"
+
+    def body(self, packet):
+        """Serialize a packet dict into a frame body"""
+        return json.dumps(packet).encode('utf-8')
+
+    def encode(self, packet):
+        """Serialize a packet dict into a complete frame"""
+        return encode_frame(self.body(packet))
+
+    def frame(self, packet):
+        """Return the frame for a packet dict or a shared Packet"""
+        return packet.frame(self) if isinstance(packet, Packet) else self.encode(packet)
+
+class CompactCodec(JsonCodec):
+    """Encodes packets as MessagePack with integer tags, integer timestamps and columnar history"""
+    name = COMPACT_CAPABILITY
+
+    def body(self, packet):
+        """Serialize a packet dict into a frame body"""
+        return msgpack.packb(compact_packet(packet))
+
+class DeflateCodec(JsonCodec):
+    """Wraps another codec, compressing bodies of COMPRESSION_THRESHOLD bytes or more"""
+
+    def __init__(self, codec):
+        """Initialize around the codec that produces the bodies"""
+        # A distinct name keeps compressed frames apart in Packet's cache, so a
+        # history packet is compressed once however many clients fetch it
+        self.codec = codec
+        self.name = f"{codec.name}+{COMPRESSION_CAPABILITY}"
+
+    def body(self, packet):
+        """Serialize a packet dict into an uncompressed frame body"""
+        return self.codec.body(packet)
+
+    def encode(self, packet):
+        """Serialize a packet dict into a complete frame, compressed if it is large"""
+        body = self.codec.body(packet)
+        if len(body) < COMPRESSION_THRESHOLD:
+            return encode_frame(body)
+        if len(body) > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {len(body)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        return encode_frame(deflate(body), compressed=True)
+
+JSON_CODEC = JsonCodec()
+COMPACT_CODEC = CompactCodec() if msgpack else None
+DEFLATE_CODECS = {codec.name: DeflateCodec(codec) for codec in (JSON_CODEC, COMPACT_CODEC) if codec}
+
+def codec_for(capabilities):
+    """Return the codec to use with a peer, given the negotiated capabilities"""
+    capabilities = capabilities or ()
+    codec = COMPACT_CODEC if COMPACT_CODEC and COMPACT_CAPABILITY in capabilities else JSON_CODEC
+    if COMPRESSION_CAPABILITY in capabilities:
+        return DEFLATE_CODECS[codec.name]
+    return codec
+
+def is_legacy_packet(data):
+    """Check whether the first bytes from a peer are unframed JSON"""
+    # Frame headers start with a zero byte for any sane length, raw JSON starts with '{'
+    return data[:1] == b"{"
+
+def negotiate(offered, supported=SERVER_CAPABILITIES):
+    """Return the capabilities both sides support, in the server's order"""
+    offered = set(offered or ())
+    return [capability for capability in supported if capability in offered]
+
+class FrameDecoder:
+    """Incremental decoder that turns a byte stream into complete frames"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """Initialize an empty receive buffer"""
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """Append received bytes and return every frame that is now complete"""
+        # Frames are sliced by offset and the consumed prefix is dropped once per
+        # call, so a burst of small frames does not re-copy the buffer per frame
+        buffer = self.buffer
+        buffer.extend(data)
+        frames = []
+        offset = 0
+        available = len(buffer)
+
+        while available - offset >= HEADER.size:
+            (header,) = HEADER.unpack_from(buffer, offset)
+            length = header & LENGTH_MASK
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Incoming frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+
+            end = offset + HEADER.size + length
+            if end > available:
+                break
+
+            frame = bytes(buffer[offset + HEADER.size:end])
+            frames.append(inflate(frame, self.max_frame_size) if header & COMPRESSED_FLAG else frame)
+            offset = end
+
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def pending(self):
+        """Return the number of buffered bytes that are not yet a full frame"""
+        return len(self.buffer)
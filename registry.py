@@ -0,0 +1,139 @@
+import threading
+import itertools
+
+class ClientRecord:
+    """A logged-in connection"""
+    __slots__ = ("conn_id", "username", "role", "send", "socket", "rooms")
+
+    def __init__(self, conn_id, username, role, send):
+        """Initialize a record for a connection"""
+        self.conn_id = conn_id
+        self.username = username
+        self.role = role
+        self.send = send
+        self.socket = None
+        self.rooms = frozenset()
+
+class ClientRegistry:
+    """Thread-safe index of connected clients by connection id, username and room"""
+
+    def __init__(self):
+        """Initialize an empty registry"""
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.by_id = {}
+        self.by_username = {}
+        self.cached_snapshot = ()
+        
+        # room -> {conn_id: record}, with a cached fan-out tuple per room
+        self.rooms = {}
+        self.room_snapshots = {}
+
+    def add(self, username, role, send):
+        """Register a connection and return its record"""
+        with self.lock:
+            record = ClientRecord(next(self.ids), username, role, send)
+            self.by_id[record.conn_id] = record
+            self.by_username.setdefault(username, {})[record.conn_id] = record
+            self.cached_snapshot = None
+        return record
+
+    def remove(self, record):
+        """Unregister a connection, returning False if it was already gone"""
+        with self.lock:
+            if self.by_id.pop(record.conn_id, None) is None:
+                return False
+
+            connections = self.by_username.get(record.username)
+            if connections is not None:
+                connections.pop(record.conn_id, None)
+                if not connections:
+                    del self.by_username[record.username]
+            self.cached_snapshot = None
+            
+            for room in record.rooms:
+                self.drop_member(record, room)
+        return True
+
+    def join(self, record, room):
+        """Subscribe a connection to a room, returning False if already a member"""
+        with self.lock:
+            if room in record.rooms or record.conn_id not in self.by_id:
+                return False
+            self.rooms.setdefault(room, {})[record.conn_id] = record
+            self.room_snapshots.pop(room, None)
+            record.rooms = record.rooms | {room}
+        return True
+
+    def leave(self, record, room):
+        """Unsubscribe a connection from a room, returning False if not a member"""
+        with self.lock:
+            if room not in record.rooms:
+                return False
+            self.drop_member(record, room)
+            record.rooms = record.rooms - {room}
+        return True
+
+    def drop_member(self, record, room):
+        """Remove a record from a room's member set (called with the lock held)"""
+        members = self.rooms.get(room)
+        if members is not None:
+            members.pop(record.conn_id, None)
+            if not members:
+                del self.rooms[room]
+        self.room_snapshots.pop(room, None)
+
+    def members(self, room):
+        """Return an immutable tuple of a room's members for fan-out"""
+        snapshot = self.room_snapshots.get(room)
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.room_snapshots.get(room)
+                if snapshot is None:
+                    if room not in self.rooms:
+                        return ()
+                    snapshot = tuple(self.rooms[room].values())
+                    self.room_snapshots[room] = snapshot
+        return snapshot
+
+    def room_names(self):
+        """Return the rooms that currently have members"""
+        with self.lock:
+            return sorted(self.rooms)
+
+    def get(self, conn_id):
+        """Look a connection up by id"""
+        return self.by_id.get(conn_id)
+
+    def for_username(self, username):
+        """Return every connection logged in as a username"""
+        with self.lock:
+            return tuple(self.by_username.get(username, {}).values())
+
+    def is_online(self, username):
+        """Check whether a username has at least one connection"""
+        return username in self.by_username
+
+    def snapshot(self):
+        """Return an immutable tuple of all records for fan-out"""
+        # Rebuilt only after a connect or disconnect; broadcasts in between share it
+        snapshot = self.cached_snapshot
+        if snapshot is None:
+            with self.lock:
+                if self.cached_snapshot is None:
+                    self.cached_snapshot = tuple(self.by_id.values())
+                snapshot = self.cached_snapshot
+        return snapshot
+
+    def clear(self):
+        """Forget every connection"""
+        with self.lock:
+            self.by_id.clear()
+            self.by_username.clear()
+            self.cached_snapshot = ()
+            self.rooms.clear()
+            self.room_snapshots.clear()
+
+    def __len__(self):
+        """Return the number of connections"""
+        return len(self.by_id)
@@ -0,0 +1,166 @@
+import logging
+import os
+import gzip
+import json
+import threading
+import datetime
+import functools
+
+logger = logging.getLogger(__name__)
+
+# Largest id SQLite can store; used as an open upper bound for id ranges
+MAX_ID = 2 ** 63 - 1
+
+class RetentionManager:
+    """Moves expired messages into compressed archive segments and compacts the database"""
+
+    def __init__(self, db, max_age_days=None, max_rows=None, archive_dir="archive",
+                 interval=3600, segment_size=5000, pause=0.05):
+        """Initialize with the retention limits applied to every room"""
+        # max_age_days and max_rows are both optional; a message past either limit is archived
+        self.db = db
+        self.max_age_days = max_age_days
+        self.max_rows = max_rows
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.segment_size = segment_size
+        self.pause = pause
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def enabled(self):
+        """Check whether any retention limit is configured"""
+        return self.max_age_days is not None or self.max_rows is not None
+
+    def start(self):
+        """Start the background retention thread if a limit is configured"""
+        if self.enabled and not self.thread:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop the background thread, letting the current segment finish"""
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """Apply retention now and then every interval seconds"""
+        while not self.stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception("Error applying retention: %s", e)
+            self.stopping.wait(self.interval)
+
+    def run_once(self):
+        """Archive expired messages in every room, then compact the database"""
+        archived = 0
+        for room in self.db.get_message_rooms():
+            if self.stopping.is_set():
+                break
+            archived += self.archive_room(room)
+
+        freed = self.db.compact()
+        if archived or freed:
+            logger.info("Retention archived %d messages and freed %d pages", archived, freed)
+        return archived
+
+    def archive_room(self, room):
+        """Archive a room's expired messages, oldest first, one segment at a time"""
+        boundary = self.db.get_row_limit_boundary(room, self.max_rows) if self.max_rows is not None else 0
+        cutoff = None
+        if self.max_age_days is not None:
+            cutoff = (datetime.datetime.now() - datetime.timedelta(days=self.max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+
+        archived = 0
+        while not self.stopping.is_set():
+            rows = self.db.get_messages_between(0, MAX_ID, self.segment_size, room)
+            expired = []
+            for row in rows:
+                if row["id"] > boundary and (cutoff is None or row["timestamp"] >= cutoff):
+                    break
+                expired.append(row)
+
+            if not expired:
+                break
+
+            self.write_segment(room, expired)
+            archived += len(expired)
+
+            # A live message was reached, or nothing is left
+            if len(expired) < self.segment_size:
+                break
+
+            # Give the message writer a turn at the write lock between segments
+            self.stopping.wait(self.pause)
+
+        return archived
+
+    def write_segment(self, room, messages):
+        """Write messages to a gzip JSONL file, then swap them out of the database"""
+        # The file is complete on disk before the rows are deleted; a crash in
+        # between leaves a file that the next run overwrites with the same range
+        os.makedirs(self.archive_dir, exist_ok=True)
+        first_id, last_id = messages[0]["id"], messages[-1]["id"]
+        path = os.path.join(self.archive_dir, f"{room}-{first_id}-{last_id}.jsonl.gz")
+
+        # The gzip stream is closed, writing its trailer, before the raw file
+        # is synced, and the rename is synced through the directory
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for message in messages:
+                    f.write((json.dumps(message) + "\n").encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(temp_path, path)
+        fsync_directory(self.archive_dir)
+
+        self.db.archive_messages({
+            "room": room,
+            "first_id": first_id,
+            "last_id": last_id,
+            "first_timestamp": messages[0]["timestamp"],
+            "last_timestamp": messages[-1]["timestamp"],
+            "message_count": len(messages),
+            "path": path
+        })
+
+    def get_messages_before(self, before_id, limit, room):
+        """Get up to limit archived messages of a room older than before_id, oldest first"""
+        messages = []
+        for segment in self.db.get_archive_segments(room, before_id):
+            older = [m for m in read_segment(segment["path"]) if m["id"] < before_id]
+            messages = older + messages
+            if len(messages) >= limit:
+                break
+
+        return messages[-limit:]
+
+@functools.lru_cache(maxsize=8)
+def read_segment(path):
+    """Read an archive segment, oldest first"""
+    # Scroll-back walks consecutive pages through the same segment, so the
+    # last few decoded segments are kept
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return tuple(json.loads(line) for line in f)
+    except (OSError, EOFError, ValueError) as e:
+        # A missing or truncated segment costs its messages, not the page
+        logger.error("Error reading archive segment %s: %s", path, e)
+        return ()
+
+def fsync_directory(path):
+    """Flush a directory's entries to disk where the platform allows it"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
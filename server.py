@@ -1,30 +1,108 @@
+import logging
 import socket
 import threading
 import json
 import datetime
+import functools
+import time
 from database import Database
+from message_writer import MessageWriter
+from history import HistoryCache
+from auth import Authenticator
+from registry import ClientRegistry
+from retention import RetentionManager
+from federation import Federation, PeerLink
+from metrics import Metrics, timed
+from outbox import ThreadedOutbox
+from protocol import DEFAULT_ROOM, FrameDecoder, Packet, decode_packet, is_legacy_packet, negotiate, codec_for
+from utils import validate_room_name
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ("threaded", "asyncio")
+
+HISTORY_PAGE_LIMIT = 200
+
+# A reconnecting client further behind than this gets a reset and fresh history
+MAX_RESYNC_MESSAGES = 2000
+RESYNC_CHUNK_SIZE = 200
+
+# Search results are paged by offset; deep pages re-rank every match, so they are capped
+SEARCH_PAGE_LIMIT = 50
+MAX_SEARCH_OFFSET = 1000
+
+# Packet types timed individually; anything else a client sends is timed as "other"
+TIMED_PACKETS = ("message", "history_before", "search", "direct_message", "join_room", "leave_room", "stats")
 
 class Server:
-    def __init__(self, host="0.0.0.0", port=5555):
-        """Initialize server with host and port"""
+    def __init__(self, host="0.0.0.0", port=5555, outbox_size=1024, overflow_policy="drop_oldest",
+                 persistence="batched", auth_processes=2, retention_days=None, retention_rows=None,
+                 archive_dir="archive", db_file="forum.db", backlog=5, reuse_port=False,
+                 node=None, peers=(), peer_secret=None):
+        """Initialize server with host, port, database, send queue, persistence, login, retention and peering settings"""
+        # A memory-mode node would restart its ids below what its peers have
+        # already seen from it, and they would drop everything it posts next
+        if peer_secret and persistence == "memory":
+            raise ValueError("Peering needs messages persisted to the database")
+        
         # Set up server properties
         self.host = host
         self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.outbox_size = outbox_size
+        self.overflow_policy = overflow_policy
         self.server_socket = None
-        self.clients = []
-        self.db = Database()
+        self.clients = ClientRegistry()
+        
+        # Every database call is timed, whichever component makes it
+        self.metrics = Metrics()
+        self.db = Database(db_file)
+        self.metrics.instrument(self.db, "db", exclude=("connection", "close"))
+        self.writer = MessageWriter(self.db, persistence)
+        self.auth = Authenticator(auth_processes)
+        self.retention = RetentionManager(self.db, retention_days, retention_rows, archive_dir)
+        
+        # Recent history is served from memory instead of querying on every login;
+        # each room gets its own ring while it has members
+        self.histories = {}
+        self.histories_lock = threading.Lock()
+        
+        # Numbering and delivering a chat message is one step, so every client
+        # receives a room's messages in id order and resyncs never skip one
+        self.delivery_lock = threading.Lock()
+        
+        # The same for direct messages, so a client never sees DM N+1 before N
+        # and skips N on its next last_dm_id sync; a lock of their own keeps
+        # their synchronous writes from holding up room broadcasts
+        self.direct_lock = threading.Lock()
+        
+        self.history_for(DEFAULT_ROOM)
         self.running = False
         
+        # Set when this server is one worker of a cluster; broadcasts, direct
+        # messages, presence and session tokens then go through the hub
+        self.bus = None
+        
+        # Set when peering with other forum servers, which share room messages;
+        # the node name must stay the same across restarts
+        self.federation = None
+        if peer_secret:
+            self.federation = Federation(self, node or f"{socket.gethostname()}:{port}", peers, peer_secret)
+        
     def start(self):
         """Start the server"""
         # Bind the server socket and start listening for connections
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Cluster workers each listen on the same port and the kernel spreads connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        self.running = True
+        self.server_socket.listen(self.backlog)
+        self.start_services()
         
-        print(f"Server started on {self.host}:{self.port}")
+        logger.info("Server started on %s:%s", self.host, self.port)
         
         # Start accepting client connections
         accept_thread = threading.Thread(target=self.accept_connections)
@@ -38,14 +116,43 @@ class Server:
         # Close the server socket and disconnect all clients
         self.running = False
         if self.server_socket:
+            # Closing alone leaves the port bound while accept() is blocked on it;
+            # shutting the socket down wakes accept() first
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.server_socket.close()
         
         # Disconnect all clients
-        for client in self.clients[:]:
-            client["socket"].close()
+        for client in self.clients.snapshot():
+            if client.socket:
+                client.socket.close()
         
-        self.clients = []
-        print("Server stopped")
+        self.stop_services()
+        logger.info("Server stopped")
+    
+    def start_services(self):
+        """Start what both engines share: the message writer, bcrypt pool, retention and peering"""
+        self.running = True
+        self.writer.start()
+        self.auth.start()
+        self.retention.start()
+        if self.federation:
+            self.federation.start()
+    
+    def stop_services(self):
+        """Stop the shared services, committing queued messages, and close the database"""
+        self.running = False
+        self.clients.clear()
+        if self.federation:
+            self.federation.stop()
+        
+        # Commit any messages still waiting in the write-behind queue
+        self.writer.stop()
+        self.auth.stop()
+        self.retention.stop()
+        self.db.close()
         
     def accept_connections(self):
         """Accept incoming client connections"""
@@ -53,7 +160,7 @@ class Server:
         while self.running:
             try:
                 client_socket, address = self.server_socket.accept()
-                print(f"Connection from {address}")
+                logger.info("Connection from %s", address)
                 
                 # Start a thread to handle this client
                 client_thread = threading.Thread(
@@ -65,140 +172,556 @@ class Server:
                 
             except Exception as e:
                 if self.running:
-                    print(f"Error accepting connection: {e}")
+                    logger.error("Error accepting connection: %s", e)
     
     def handle_client(self, client_socket, address):
         """Handle communication with a connected client"""
         # Authenticate the client and process their messages
-        username = None
+        client = None
+        decoder = FrameDecoder()
+        
+        # Outgoing frames are queued and sent by a writer thread
+        outbox = ThreadedOutbox(self.outbox_size, self.overflow_policy, metrics=self.metrics)
+        writer_thread = outbox.start_writer(client_socket)
+        self.metrics.add("connections.opened")
         
         try:
-            # First message should be login credentials
-            data = client_socket.recv(1024).decode('utf-8')
-            login_data = json.loads(data)
+            # First frame should be login credentials
+            frames = []
+            while not frames:
+                data = client_socket.recv(4096)
+                if not data:
+                    return
+                self.metrics.add("bytes.in", len(data))
+                if is_legacy_packet(data) and not decoder.pending():
+                    self.reject_legacy_client(client_socket.sendall)
+                    return
+                frames = decoder.feed(data)
             
-            if login_data.get("type") == "login":
-                username = login_data.get("username")
-                password = login_data.get("password")
+            client = self.login_client(decode_packet(frames[0]), outbox)
+            if client:
+                client.socket = client_socket
                 
-                # Verify credentials
-                user = self.db.get_user(username)
+                # Handle any frames that arrived together with the login
+                for frame in frames[1:]:
+                    self.handle_packet(client, decode_packet(frame))
                 
-                if user and self.verify_login(user, password):
-                    # Login successful
-                    response = {
-                        "type": "login_response",
-                        "success": True,
-                        "role": user["role"]
-                    }
-                    client_socket.send(json.dumps(response).encode('utf-8'))
-                    
-                    # Add to clients list
-                    self.clients.append({
-                        "socket": client_socket,
-                        "username": username,
-                        "role": user["role"]
-                    })
-                    
-                    # Send recent message history
-                    self.send_message_history(client_socket)
-                    
-                    # Broadcast that a new user joined
-                    self.broadcast_message(username, f"{username} has joined the chat", system=True)
-                    
-                    # Handle messages from this client
-                    self.handle_messages(client_socket, username)
-                else:
-                    # Login failed
-                    response = {
-                        "type": "login_response",
-                        "success": False,
-                        "message": "Invalid username or password"
-                    }
-                    client_socket.send(json.dumps(response).encode('utf-8'))
-                    client_socket.close()
-            else:
-                client_socket.close()
+                # Handle messages from this client
+                self.handle_messages(client_socket, client, decoder)
         
         except Exception as e:
-            print(f"Error handling client {address}: {e}")
+            logger.error("Error handling client %s: %s", address, e)
         finally:
-            # Remove from clients list
-            self.clients = [c for c in self.clients if c["socket"] != client_socket]
+            self.logout_client(client)
             
-            if username:
-                # Broadcast that user left
-                self.broadcast_message(username, f"{username} has left the chat", system=True)
+            # Let the writer flush what is already queued before closing
+            outbox.close()
+            writer_thread.join(timeout=5)
             
             if client_socket:
                 client_socket.close()
+            self.metrics.add("connections.closed")
+    
+    @timed("login")
+    def login_client(self, login_data, outbox):
+        """Authenticate a login packet and register the client"""
+        # Reply through the connection's outbox so every engine shares the same protocol
+        send = outbox.put
+        if login_data.get("type") == "peer_hello":
+            # Another forum server gets a peer link instead of a session
+            if not self.federation:
+                self.send_error(send, "Peering is not enabled on this server")
+                return None
+            return self.federation.accept(login_data, outbox)
+        if login_data.get("type") != "login":
+            return None
+        
+        username = login_data.get("username")
+        password = login_data.get("password")
+        token = login_data.get("token")
+        capabilities = negotiate(login_data.get("capabilities"))
+        
+        # Verify credentials; a live session token skips the bcrypt check
+        user = self.db.get_user(username)
+        
+        if user and token and self.auth.resume(token, username):
+            authenticated = True
+        else:
+            authenticated = bool(user and self.verify_login(user, password))
+            stale_token = token
+            token = self.auth.issue_token(username) if authenticated else None
+            if token and stale_token:
+                # The new session replaces the one the client presented
+                self.auth.revoke(stale_token, username)
+            if token and self.bus:
+                # A reconnect may land on another worker
+                self.bus.share_token(token, username, stale_token)
+        
+        if not authenticated:
+            # Login failed
+            self.metrics.add("logins.failed")
+            response = {
+                "type": "login_response",
+                "success": False,
+                "message": "Invalid username or password"
+            }
+            send(response)
+            return None
+        
+        # Login successful
+        self.metrics.add("logins.succeeded")
+        response = {
+            "type": "login_response",
+            "success": True,
+            "role": user["role"],
+            "capabilities": capabilities,
+            "token": token
+        }
+        send(response)
+        
+        # The response itself is JSON; everything after it uses the negotiated codec
+        outbox.codec = codec_for(capabilities)
+        
+        # Add to clients registry; everyone starts in the default room
+        client = self.clients.add(username, user["role"], send)
+        self.clients.join(client, DEFAULT_ROOM)
+        if self.bus:
+            self.bus.publish_presence(username, True)
+        
+        # Send recent message history, or only what was missed on a reconnect
+        self.send_message_history(send, login_data.get("last_seen_id"))
+        self.send_direct_history(send, username, login_data.get("last_dm_id"))
+        
+        # Broadcast that a new user joined
+        self.broadcast_message(username, f"{username} has joined the chat", system=True)
+        return client
     
+    def reject_legacy_client(self, send):
+        """Tell a client that predates framed packets to upgrade"""
+        # Reply in the old unframed format so the client can display the reason
+        response = {
+            "type": "login_response",
+            "success": False,
+            "message": "Client is too old for this server, please upgrade"
+        }
+        send(json.dumps(response).encode('utf-8'))
+    
+    def logout_client(self, client):
+        """Remove a client from the clients registry and announce the departure"""
+        if client is None:
+            return
+        if isinstance(client, PeerLink):
+            self.federation.drop(client)
+            return
+        
+        rooms = client.rooms
+        if not self.clients.remove(client):
+            return
+        if self.bus:
+            self.bus.publish_presence(client.username, False)
+        
+        # Broadcast that user left, in every room they were in
+        username = client.username
+        for room in rooms:
+            self.broadcast_message(username, f"{username} has left the chat", system=True, room=room)
+            self.release_history(room)
+    
+    @timed("login.bcrypt")
     def verify_login(self, user, password):
         """Verify login credentials"""
-        # Check the provided password against the stored hash
-        from utils import verify_password
-        return verify_password(user["password"], password)
+        # Check the provided password against the stored hash on the bcrypt pool
+        return self.auth.verify(user["password"], password)
     
-    def handle_messages(self, client_socket, username):
+    def handle_messages(self, client_socket, client, decoder):
         """Handle incoming messages from a client"""
         # Process and broadcast messages from the client
         while self.running:
             try:
-                data = client_socket.recv(4096).decode('utf-8')
+                data = client_socket.recv(4096)
                 if not data:
                     break
+                self.metrics.add("bytes.in", len(data))
                 
-                message_data = json.loads(data)
-                
-                if message_data.get("type") == "message":
-                    content = message_data.get("content")
-                    
-                    # Broadcast the message to all clients
-                    self.broadcast_message(username, content)
+                for frame in decoder.feed(data):
+                    self.handle_packet(client, decode_packet(frame))
                     
             except Exception as e:
-                print(f"Error receiving message from {username}: {e}")
+                logger.error("Error receiving message from %s: %s", client.username, e)
                 break
     
-    def broadcast_message(self, username, content, system=False):
-        """Broadcast a message to all connected clients"""
-        # Send a message to all connected clients
+    def handle_packet(self, client, message_data):
+        """Process a single packet received from a logged-in client"""
+        if isinstance(client, PeerLink):
+            self.federation.receive(client, message_data)
+            return
+        
+        packet_type = message_data.get("type")
+        started = time.perf_counter()
+        try:
+            self.dispatch_packet(client, packet_type, message_data)
+        finally:
+            name = packet_type if packet_type in TIMED_PACKETS else "other"
+            self.metrics.observe(f"packet.{name}", time.perf_counter() - started)
+    
+    def dispatch_packet(self, client, packet_type, message_data):
+        """Run the handler for one packet type"""
+        if packet_type == "message":
+            content = message_data.get("content")
+            room = message_data.get("room", DEFAULT_ROOM)
+            
+            if not isinstance(content, str) or not content:
+                return
+            if room not in client.rooms:
+                self.send_error(client.send, f"You are not in room '{room}'")
+                return
+            
+            # Broadcast the message to the room's members
+            self.broadcast_message(client.username, content, room=room)
+        
+        elif packet_type == "history_before":
+            # Scroll-back request for messages older than the client's oldest
+            self.send_history_page(client.send, message_data)
+        
+        elif packet_type == "search":
+            self.send_search_results(client.send, message_data)
+        
+        elif packet_type == "direct_message":
+            self.send_direct_message(client, message_data.get("to"), message_data.get("content"))
+        
+        elif packet_type == "join_room":
+            self.join_room(client, message_data.get("room"), message_data.get("last_seen_id"))
+        
+        elif packet_type == "leave_room":
+            self.leave_room(client, message_data.get("room"))
+        
+        elif packet_type == "stats":
+            self.send_stats(client)
+    
+    def send_error(self, send, message):
+        """Send an error packet to one client"""
+        send({"type": "error", "message": message})
+    
+    def send_stats(self, client):
+        """Send the server's metrics to an admin"""
+        if client.role != "admin":
+            self.send_error(client.send, "Only admins can request server statistics")
+            return
+        
+        client.send({"type": "stats", "stats": self.stats()})
+    
+    def stats(self):
+        """Return counters, latency histograms and current gauges"""
+        stats = self.metrics.snapshot()
+        stats["gauges"] = {
+            "clients": len(self.clients.snapshot()),
+            "rooms": len(self.clients.room_names()),
+            "pending_writes": self.writer.queue.qsize()
+        }
+        if self.bus:
+            stats["gauges"]["worker"] = self.bus.index
+            stats["gauges"]["cluster_users_online"] = self.bus.users_online()
+        if self.federation:
+            stats["gauges"]["peers"] = len(self.federation.links)
+        return stats
+    
+    def join_room(self, client, room, last_seen_id=None):
+        """Subscribe a client to a room and send its history"""
+        if not validate_room_name(room):
+            self.send_error(client.send, "Invalid room name")
+            return
+        
+        if not self.clients.join(client, room):
+            return
+        
+        client.send({"type": "room_joined", "room": room})
+        self.send_message_history(client.send, last_seen_id, room)
+        self.broadcast_message(client.username, f"{client.username} has joined #{room}", system=True, room=room)
+    
+    def leave_room(self, client, room):
+        """Unsubscribe a client from a room"""
+        if room == DEFAULT_ROOM or not self.clients.leave(client, room):
+            return
+        
+        client.send({"type": "room_left", "room": room})
+        self.broadcast_message(client.username, f"{client.username} has left #{room}", system=True, room=room)
+        self.release_history(room)
+    
+    def history_for(self, room):
+        """Return a room's history ring, warming it from the database on first use"""
+        history = self.histories.get(room)
+        if history is None:
+            with self.histories_lock:
+                history = self.histories.get(room)
+                if history is None:
+                    # Registered before warming, so messages delivered meanwhile land
+                    # in it; the warm-up only adds what is older, once it is committed
+                    history = self.histories[room] = HistoryCache(100, room)
+                    self.writer.flush()
+                    history.warm(self.db.get_messages(100, room))
+        return history
+    
+    def release_history(self, room):
+        """Forget a room's history ring once nobody is left in it"""
+        # The ring is rebuilt from the database if someone joins again; in
+        # memory mode it holds the only copy, so it is kept
+        if room == DEFAULT_ROOM or self.writer.mode == "memory" or self.clients.members(room):
+            return
+        with self.histories_lock:
+            if not self.clients.members(room):
+                self.histories.pop(room, None)
+    
+    @timed("broadcast")
+    def broadcast_message(self, username, content, system=False, room=DEFAULT_ROOM):
+        """Broadcast a message to every member of a room"""
+        # Send a message to the room's connected clients
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        # Save to database (unless it's a system message)
-        if not system:
-            self.db.save_message(username, content, timestamp)
+        # In a cluster the hub numbers the message and hands it back to every
+        # worker, this one included, so all of them deliver in the same order
+        if self.bus:
+            self.bus.publish_message(username, content, timestamp, room, system)
+        elif system:
+            self.deliver_notice(content, timestamp, room)
+        elif self.federation:
+            # Numbered, delivered and forwarded to peers under one lock, so
+            # peers receive this server's messages in id order
+            self.federation.publish(username, content, timestamp, room)
+        else:
+            # Save to database (queued unless persistence is "sync")
+            with self.delivery_lock:
+                self.deliver_message(self.writer.save(username, content, timestamp, room))
+    
+    def deliver_message(self, message):
+        """Add a numbered chat message to its room's history and send it to the local members"""
+        room = message["room"]
+        # Only rooms with members have a ring; the rest are read from the database
+        history = self.histories.get(room)
+        if history is not None:
+            history.append(message)
         
-        # Create message packet
-        message_packet = {
+        # Build the packet once; it is encoded once per codec and the bytes are
+        # shared by every client's outbox
+        self.fan_out(room, Packet({
             "type": "message",
-            "username": "SYSTEM" if system else username,
-            "timestamp": timestamp,
-            "content": content,
-            "system": system
-        }
+            "id": message["id"],
+            "room": room,
+            "username": message["username"],
+            "timestamp": message["timestamp"],
+            "content": message["content"],
+            "system": False
+        }))
+        self.metrics.add("messages.chat")
+    
+    def deliver_notice(self, content, timestamp, room):
+        """Send a system notice to the local members of a room"""
+        self.fan_out(room, system_notice(content, timestamp, room))
+        self.metrics.add("messages.system")
+    
+    def fan_out(self, room, packet):
+        """Queue a packet for every local member of a room"""
+        # Each client's writer does the actual send
+        members = self.clients.members(room)
+        for client in members:
+            client.send(packet)
+        self.metrics.add("broadcast.recipients", len(members))
+    
+    def send_direct_message(self, client, recipient, content):
+        """Deliver a private message to every connection of the recipient"""
+        if not isinstance(content, str) or not content:
+            return
         
-        packet_json = json.dumps(message_packet)
+        # Someone online is a known user; only offline recipients need a database lookup
+        if not isinstance(recipient, str) or not (self.is_online(recipient) or self.db.get_user(recipient)):
+            self.send_error(client.send, f"Unknown user '{recipient}'")
+            return
         
-        # Send to all clients
-        for client in self.clients[:]:
-            try:
-                client["socket"].send(packet_json.encode('utf-8'))
-            except Exception:
-                # If sending fails, this client is probably disconnected
-                pass
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if self.bus:
+            self.bus.publish_direct(client.username, recipient, content, timestamp)
+        else:
+            with self.direct_lock:
+                self.deliver_direct(self.writer.save_direct(client.username, recipient, content, timestamp))
     
-    def send_message_history(self, client_socket):
-        """Send message history to a newly connected client"""
-        # Retrieve and send the last 100 messages to the client
-        messages = self.db.get_messages(100)  # Get last 100 messages
+    def deliver_direct(self, message):
+        """Send a numbered direct message to the local sessions of both ends"""
+        packet = Packet({"type": "direct_message", **message})
         
-        history_packet = {
-            "type": "message_history",
-            "messages": messages
-        }
+        # Username index lookups for both ends; the sender's own sessions get the
+        # echo so every window shows the conversation with its id
+        recipient, sender = message["recipient"], message["sender"]
+        targets = self.clients.for_username(recipient)
+        if recipient != sender:
+            targets += self.clients.for_username(sender)
+        for target in targets:
+            target.send(packet)
+    
+    def is_online(self, username):
+        """Check whether a user has a session on this server or, in a cluster, any worker"""
+        return self.clients.is_online(username) or bool(self.bus and self.bus.is_online(username))
+    
+    def send_direct_history(self, send, username, last_dm_id=None):
+        """Send a user's direct messages, or only those after last_dm_id on a reconnect"""
+        try:
+            last_dm_id = int(last_dm_id)
+        except (TypeError, ValueError):
+            last_dm_id = None
+        
+        # Fresh login, or ahead of us (e.g. the database was replaced): recent conversation only
+        if last_dm_id is None or last_dm_id > self.writer.last_direct_id:
+            messages = self.db.get_recent_direct_messages(username, 100)
+            send({"type": "direct_history", "messages": messages})
+            return
+        
+        # Otherwise stream everything missed in chunks; since_id marks it as a continuation
+        cursor = last_dm_id
+        while True:
+            chunk = self.db.get_direct_messages_after(username, cursor, RESYNC_CHUNK_SIZE)
+            if chunk:
+                send({"type": "direct_history", "since_id": cursor, "messages": chunk})
+                cursor = chunk[-1]["id"]
+            if len(chunk) < RESYNC_CHUNK_SIZE:
+                break
+    
+    @timed("history")
+    def send_message_history(self, send, last_seen_id=None, room=DEFAULT_ROOM):
+        """Send a room's message history to a client"""
+        # The last 100 messages come from the in-memory ring as one cached packet
+        history = self.history_for(room)
+        if last_seen_id is None:
+            send(history.history_packet())
+            return
         
         try:
-            client_socket.send(json.dumps(history_packet).encode('utf-8'))
-        except Exception as e:
-            print(f"Error sending message history: {e}")
\ No newline at end of file
+            last_seen_id = int(last_seen_id)
+        except (TypeError, ValueError):
+            send(history.history_packet())
+            return
+        
+        recent = history.snapshot()
+        ring_start = recent[0]["id"] if recent else self.writer.last_id + 1
+        
+        # The gap older than the ring is read from the database, which must not
+        # be missing rows still queued in the write-behind writer
+        behind_ring = last_seen_id < ring_start - 1
+        if behind_ring:
+            self.writer.flush()
+        
+        # Too far behind, or ahead of us (e.g. the database was replaced): start over
+        if last_seen_id > self.writer.last_id or (
+            behind_ring and
+            self.db.count_messages_between(last_seen_id, ring_start, MAX_RESYNC_MESSAGES + 1, room) > MAX_RESYNC_MESSAGES
+        ):
+            send({"type": "history_reset", "room": room})
+            send(history.history_packet())
+            return
+        
+        # Stream the gap older than the ring from the database in chunks
+        cursor = last_seen_id
+        while cursor < ring_start - 1:
+            chunk = self.db.get_messages_between(cursor, ring_start, RESYNC_CHUNK_SIZE, room)
+            if not chunk:
+                break
+            send({"type": "message_history", "room": room, "since_id": cursor, "messages": chunk})
+            cursor = chunk[-1]["id"]
+        
+        # Then whatever the ring holds after that
+        delta = [m for m in recent if m["id"] > cursor]
+        send({"type": "message_history", "room": room, "since_id": cursor, "messages": delta})
+
+    def send_history_page(self, send, request):
+        """Send one page of a room's messages older than the requested id"""
+        room = request.get("room", DEFAULT_ROOM)
+        try:
+            before_id = int(request.get("before_id"))
+            limit = max(1, min(int(request.get("limit", 50)), HISTORY_PAGE_LIMIT))
+        except (TypeError, ValueError):
+            self.send_error(send, "Invalid history request")
+            return
+        
+        if not validate_room_name(room):
+            self.send_error(send, "Invalid room name")
+            return
+        
+        messages, has_more = self.get_history_page(before_id, limit, room)
+        send({
+            "type": "history_page",
+            "room": room,
+            "before_id": before_id,
+            "messages": messages,
+            "has_more": has_more
+        })
+    
+    def send_search_results(self, send, request):
+        """Send one page of full-text search results"""
+        if not self.db.search_enabled:
+            self.send_error(send, "Search is not available on this server")
+            return
+        
+        query = request.get("query")
+        filters = [request.get(key) for key in ("username", "room", "since", "until")]
+        try:
+            limit = max(1, min(int(request.get("limit", 20)), SEARCH_PAGE_LIMIT))
+            offset = max(0, min(int(request.get("offset", 0)), MAX_SEARCH_OFFSET))
+        except (TypeError, ValueError):
+            self.send_error(send, "Invalid search request")
+            return
+        
+        if not isinstance(query, str) or not query.strip() or not all(f is None or isinstance(f, str) for f in filters):
+            self.send_error(send, "Invalid search request")
+            return
+        
+        # One extra row tells us whether another page exists
+        messages = self.db.search_messages(query, *filters, limit=limit + 1, offset=offset)
+        send({
+            "type": "search_results",
+            "query": query,
+            "offset": offset,
+            "messages": messages[:limit],
+            "has_more": len(messages) > limit
+        })
+    
+    def get_history_page(self, before_id, limit, room=DEFAULT_ROOM):
+        """Get up to limit messages older than before_id and whether more exist"""
+        # The ring may hold messages the write-behind queue has not committed yet,
+        # so take what it has and only ask the database for what is older;
+        # archive segments are only opened once the database runs out
+        history = self.histories.get(room)
+        recent = history.snapshot() if history else []
+        messages = [m for m in recent if m["id"] < before_id][-(limit + 1):]
+        if len(messages) <= limit:
+            # Rows older than the ring may still be queued for the database
+            self.writer.flush()
+            cursor = messages[0]["id"] if messages else before_id
+            messages = self.db.get_messages_before(cursor, limit + 1 - len(messages), room) + messages
+        if len(messages) <= limit:
+            cursor = messages[0]["id"] if messages else before_id
+            messages = self.retention.get_messages_before(cursor, limit + 1 - len(messages), room) + messages
+        
+        return messages[-limit:], len(messages) > limit
+
+@functools.lru_cache(maxsize=256)
+def system_notice(content, timestamp, room=DEFAULT_ROOM):
+    """Build a system notice packet, reusing it and its frames for repeated notices"""
+    # Join/leave notices repeat during reconnect storms within the same second
+    return Packet({
+        "type": "message",
+        "room": room,
+        "username": "SYSTEM",
+        "timestamp": timestamp,
+        "content": content,
+        "system": True
+    })
+
+def create_server(engine="threaded", host="0.0.0.0", port=5555, workers=1, **options):
+    """Create a server instance for the given engine name, or a cluster of them"""
+    if workers > 1:
+        if options.get("peer_secret"):
+            raise ValueError("Peering needs a single worker process")
+        from cluster import Cluster
+        return Cluster(engine, host, port, workers, **options)
+    if engine == "threaded":
+        return Server(host, port, **options)
+    if engine == "asyncio":
+        from async_server import AsyncServer
+        return AsyncServer(host, port, **options)
+    raise ValueError(f"Unknown server engine: {engine}")
\ No newline at end of file
@@ -2,9 +2,20 @@ import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 import threading
 import socket
+import queue
+import logging
 from utils import validate_username, validate_password
 from database import Database
-from server import Server
+from server import ENGINES, create_server
+from server_log import install_queue_handler, remove_handler
+
+# Lines of server log kept in the log widget, and records drawn per refresh
+MAX_LOG_LINES = 2000
+LOG_BATCH_SIZE = 500
+LOG_REFRESH_MS = 100
+
+# How often the statistics tab reads the server's metrics
+STATS_REFRESH_MS = 1000
 
 class ServerGUI:
     def __init__(self, root):
@@ -60,12 +71,19 @@ class ServerGUI:
         self.server_tab = ttk.Frame(self.tabs, padding=10)
         self.tabs.add(self.server_tab, text="Server Control")
         
+        # Live server metrics tab
+        self.stats_tab = ttk.Frame(self.tabs, padding=10)
+        self.tabs.add(self.stats_tab, text="Statistics")
+        
         # Set up register form
         self.setup_register_form()
         
         # Set up server control
         self.setup_server_control()
         
+        # Set up statistics
+        self.setup_statistics()
+        
     def setup_register_form(self):
         """Setup the user registration form"""
         # Title
@@ -115,6 +133,12 @@ class ServerGUI:
         self.status_var = tk.StringVar(value="Not Running")
         ttk.Label(self.server_tab, textvariable=self.status_var, font=("Helvetica", 12, "bold")).grid(row=0, column=1, sticky="w", pady=5)
         
+        # Engine selection
+        ttk.Label(self.server_tab, text="Engine:").grid(row=1, column=0, sticky="w", pady=5)
+        self.engine_var = tk.StringVar(value=ENGINES[0])
+        self.engine_combo = ttk.Combobox(self.server_tab, textvariable=self.engine_var, values=ENGINES, state="readonly")
+        self.engine_combo.grid(row=1, column=1, sticky="w", pady=5)
+        
         # Start/Stop button
         self.server_button_var = tk.StringVar(value="Start Server")
         self.server_button = ttk.Button(
@@ -122,44 +146,133 @@ class ServerGUI:
             textvariable=self.server_button_var, 
             command=self.toggle_server
         )
-        self.server_button.grid(row=1, column=0, columnspan=2, pady=10)
+        self.server_button.grid(row=2, column=0, columnspan=2, pady=10)
         
         # Server log
-        ttk.Label(self.server_tab, text="Server Log:", font=("Helvetica", 12)).grid(row=2, column=0, columnspan=2, sticky="w", pady=5)
+        ttk.Label(self.server_tab, text="Server Log:", font=("Helvetica", 12)).grid(row=3, column=0, columnspan=2, sticky="w", pady=5)
         
         self.log_text = scrolledtext.ScrolledText(self.server_tab, height=15, wrap=tk.WORD)
-        self.log_text.grid(row=3, column=0, columnspan=2, sticky="nsew", pady=5)
+        self.log_text.grid(row=4, column=0, columnspan=2, sticky="nsew", pady=5)
         self.log_text.config(state=tk.DISABLED)
         
         # Connected clients
-        ttk.Label(self.server_tab, text="Connected Clients:", font=("Helvetica", 12)).grid(row=4, column=0, columnspan=2, sticky="w", pady=5)
+        ttk.Label(self.server_tab, text="Connected Clients:", font=("Helvetica", 12)).grid(row=5, column=0, columnspan=2, sticky="w", pady=5)
         
         self.clients_tree = ttk.Treeview(self.server_tab, columns=("username", "role"), show="headings")
         self.clients_tree.heading("username", text="Username")
         self.clients_tree.heading("role", text="Role")
-        self.clients_tree.grid(row=5, column=0, columnspan=2, sticky="nsew", pady=5)
+        self.clients_tree.grid(row=6, column=0, columnspan=2, sticky="nsew", pady=5)
         
         # Configure grid weights
         self.server_tab.grid_columnconfigure(1, weight=1)
-        self.server_tab.grid_rowconfigure(3, weight=1)
-        self.server_tab.grid_rowconfigure(5, weight=1)
-        
-        # Redirect standard output to log
-        import sys
-        self.original_stdout = sys.stdout
-        sys.stdout = self
+        self.server_tab.grid_rowconfigure(4, weight=1)
+        self.server_tab.grid_rowconfigure(6, weight=1)
+        
+        # Server threads only queue log records; the Tk thread draws them in batches
+        self.log_handler = install_queue_handler()
+        self.log_formatter = logging.Formatter("[%(asctime)s] %(levelname)s %(message)s", "%H:%M:%S")
+        self.log_dropped = 0
+        self.root.after(LOG_REFRESH_MS, self.drain_log)
+    
+    def setup_statistics(self):
+        """Setup the live statistics view"""
+        self.stats_var = tk.StringVar(value="Server not running")
+        ttk.Label(self.stats_tab, textvariable=self.stats_var, font=("Helvetica", 12)).grid(row=0, column=0, sticky="w", pady=5)
+        
+        # Counters with their rate since the last refresh
+        columns = ("value", "rate")
+        self.counters_tree = ttk.Treeview(self.stats_tab, columns=columns, height=8)
+        self.counters_tree.heading("#0", text="Counter")
+        self.counters_tree.heading("value", text="Total")
+        self.counters_tree.heading("rate", text="Per second")
+        self.counters_tree.grid(row=1, column=0, sticky="nsew", pady=5)
+        
+        # Latency histograms, in milliseconds
+        columns = ("count", "mean", "p50", "p99", "max")
+        self.latency_tree = ttk.Treeview(self.stats_tab, columns=columns)
+        self.latency_tree.heading("#0", text="Operation")
+        for column in columns:
+            self.latency_tree.heading(column, text=column if column == "count" else f"{column} ms")
+            self.latency_tree.column(column, width=80, anchor="e")
+        self.latency_tree.grid(row=2, column=0, sticky="nsew", pady=5)
+        
+        scrollbar = ttk.Scrollbar(self.stats_tab, orient=tk.VERTICAL, command=self.latency_tree.yview)
+        self.latency_tree.configure(yscroll=scrollbar.set)
+        scrollbar.grid(row=2, column=1, sticky="ns")
+        
+        self.stats_tab.grid_columnconfigure(0, weight=1)
+        self.stats_tab.grid_rowconfigure(2, weight=1)
+        
+        self.last_counters = {}
+        self.last_uptime = None
+        self.root.after(STATS_REFRESH_MS, self.refresh_stats)
+    
+    def refresh_stats(self):
+        """Redraw the statistics tab from the running server and schedule the next refresh"""
+        server = self.server
+        if server and server.running:
+            stats = server.stats()
+            gauges = stats["gauges"]
+            self.stats_var.set(
+                f"Up {int(stats['uptime'])}s, {gauges['clients']} clients in {gauges['rooms']} rooms, "
+                f"{gauges['pending_writes']} messages waiting to be written"
+            )
+            
+            # Rates are the change since the previous refresh of the same server
+            elapsed = stats["uptime"] - self.last_uptime if self.last_uptime is not None else 0
+            for name, value in sorted(stats["counters"].items()):
+                rate = (value - self.last_counters.get(name, 0)) / elapsed if elapsed > 0 else 0
+                self.set_row(self.counters_tree, name, (value, f"{rate:.1f}"))
+            self.last_counters = stats["counters"]
+            self.last_uptime = stats["uptime"]
+            
+            for name, summary in stats["histograms"].items():
+                values = [summary[key] for key in ("count", "mean_ms", "p50_ms", "p99_ms", "max_ms")]
+                self.set_row(self.latency_tree, name, values)
+        elif self.last_uptime is not None:
+            # The server was stopped; the next one starts counting from zero
+            self.stats_var.set("Server not running")
+            for tree in (self.counters_tree, self.latency_tree):
+                tree.delete(*tree.get_children())
+            self.last_counters = {}
+            self.last_uptime = None
+        
+        self.root.after(STATS_REFRESH_MS, self.refresh_stats)
+    
+    def set_row(self, tree, name, values):
+        """Update a statistics row in place, adding it the first time"""
+        if tree.exists(name):
+            tree.item(name, values=values)
+        else:
+            tree.insert("", tk.END, iid=name, text=name, values=values)
     
-    def write(self, text):
-        """Redirect stdout to the log text widget"""
-        if self.log_text:
+    def drain_log(self):
+        """Append queued log records to the log widget and schedule the next drain"""
+        lines = []
+        try:
+            while len(lines) < LOG_BATCH_SIZE:
+                lines.append(self.log_formatter.format(self.log_handler.queue.get_nowait()))
+        except queue.Empty:
+            pass
+        
+        dropped = self.log_handler.dropped
+        if dropped != self.log_dropped:
+            lines.append(f"... {dropped - self.log_dropped} log records dropped")
+            self.log_dropped = dropped
+        
+        if lines:
             self.log_text.config(state=tk.NORMAL)
-            self.log_text.insert(tk.END, text)
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            
+            # Cap the scrollback so the widget does not grow for the life of the server
+            excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - MAX_LOG_LINES
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
+            
             self.log_text.see(tk.END)
             self.log_text.config(state=tk.DISABLED)
-    
-    def flush(self):
-        """Required for stdout redirection"""
-        pass
+        
+        self.root.after(LOG_REFRESH_MS, self.drain_log)
     
     def show_login_frame(self):
         """Show the login frame"""
@@ -222,19 +335,9 @@ class ServerGUI:
         for item in self.users_tree.get_children():
             self.users_tree.delete(item)
         
-        # Connect to database
-        conn = self.db.connect()
-        cursor = conn.cursor()
-        
-        # Get users
-        cursor.execute("SELECT username, role FROM users ORDER BY username")
-        users = cursor.fetchall()
-        
         # Add to tree
-        for user in users:
+        for user in self.db.get_users():
             self.users_tree.insert("", tk.END, values=(user["username"], user["role"]))
-        
-        conn.close()
     
     def toggle_server(self):
         """Start or stop the server"""
@@ -244,16 +347,18 @@ class ServerGUI:
             self.server = None
             self.status_var.set("Not Running")
             self.server_button_var.set("Start Server")
+            self.engine_combo.config(state="readonly")
             
             # Clear clients tree
             for item in self.clients_tree.get_children():
                 self.clients_tree.delete(item)
         else:
             # Start server
-            self.server = Server()
+            self.server = create_server(self.engine_var.get())
             if self.server.start():
-                self.status_var.set("Running")
+                self.status_var.set(f"Running ({self.engine_var.get()})")
                 self.server_button_var.set("Stop Server")
+                self.engine_combo.config(state="disabled")
                 
                 # Start a thread to update clients list
                 update_thread = threading.Thread(target=self.update_clients_list)
@@ -269,20 +374,18 @@ class ServerGUI:
                 self.clients_tree.delete(item)
             
             # Add current clients
-            for client in self.server.clients:
-                self.clients_tree.insert("", tk.END, values=(client["username"], client["role"]))
+            for client in self.server.clients.snapshot():
+                self.clients_tree.insert("", tk.END, values=(client.username, client.role))
             
             time.sleep(2)  # Update every 2 seconds
     
     def on_close(self):
         """Handle window close event"""
         if self.server and self.server.running:
-            if messagebox.askyesno("Exit", "Server is running. Stop server and exit?"):
-                self.server.stop()
-                self.root.destroy()
-        else:
-            self.root.destroy()
+            if not messagebox.askyesno("Exit", "Server is running. Stop server and exit?"):
+                return
+            self.server.stop()
         
-        # Restore original stdout
-        import sys
-        sys.stdout = self.original_stdout
\ No newline at end of file
+        # Stop queueing log records nobody will draw
+        remove_handler(self.log_handler)
+        self.root.destroy()
\ No newline at end of file
@@ -0,0 +1,51 @@
+import sys
+import queue
+import logging
+import logging.handlers
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full"""
+    # Connection threads only pay for a put_nowait; a stalled consumer costs
+    # log lines, never chat throughput
+
+    def __init__(self, log_queue):
+        """Initialize with the queue records are handed to"""
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """Queue a record, counting it as dropped if the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def install_queue_handler(maxsize=10000, level=logging.INFO):
+    """Send every log record to a bounded queue and return the handler"""
+    handler = DroppingQueueHandler(queue.Queue(maxsize))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+def remove_handler(handler):
+    """Detach a handler installed on the root logger"""
+    logging.getLogger().removeHandler(handler)
+
+def start_background_logging(log_file=None, level=logging.INFO, max_bytes=10 * 1024 * 1024, backups=5):
+    """Write log records to stdout, and optionally a rotating file, from a listener thread"""
+    # Formatting and file I/O happen on the listener thread, not on the
+    # threads that produced the records
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = install_queue_handler(level=level)
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers)
+    listener.start()
+    return listener
@@ -0,0 +1,41 @@
+import time
+import auth
+from auth import Authenticator
+
+def test_tokens_resume_only_for_their_owner():
+    authenticator = Authenticator(processes=0)
+    token = authenticator.issue_token("bob")
+    assert authenticator.resume(token, "bob")
+    assert not authenticator.resume(token, "eve")
+    assert not authenticator.resume("made-up", "bob")
+
+def test_expired_tokens_are_refused_and_dropped():
+    authenticator = Authenticator(processes=0, token_ttl=0.05)
+    token = authenticator.issue_token("bob")
+    time.sleep(0.1)
+    assert not authenticator.resume(token, "bob")
+
+    authenticator.issue_token("amy")
+    assert list(authenticator.tokens.values())[0][0] == "amy"
+    assert len(authenticator.tokens) == 1
+
+def test_table_keeps_the_newest_sessions(monkeypatch):
+    monkeypatch.setattr(auth, "MAX_SESSIONS", 100)
+    authenticator = Authenticator(processes=0)
+    tokens = [authenticator.issue_token(f"user{number}") for number in range(150)]
+    assert len(authenticator.tokens) == 100
+    assert not authenticator.resume(tokens[0], "user0")
+    assert authenticator.resume(tokens[-1], "user149")
+
+def test_revoke_checks_the_owner():
+    authenticator = Authenticator(processes=0)
+    token = authenticator.issue_token("bob")
+    authenticator.revoke(token, "eve")
+    assert authenticator.resume(token, "bob")
+    authenticator.revoke(token, "bob")
+    assert not authenticator.resume(token, "bob")
+
+def test_adopted_tokens_resume():
+    authenticator = Authenticator(processes=0)
+    authenticator.adopt("from-another-worker", "bob")
+    assert authenticator.resume("from-another-worker", "bob")
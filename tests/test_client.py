@@ -0,0 +1,34 @@
+import threading
+import time
+from client import Client
+from protocol import FrameDecoder, decode_packet
+
+class SlowSocket:
+    """Socket stand-in whose sendall writes in two halves, as a real one may"""
+
+    def __init__(self):
+        self.stream = bytearray()
+
+    def sendall(self, data):
+        half = len(data) // 2
+        self.stream.extend(data[:half])
+        time.sleep(0.001)
+        self.stream.extend(data[half:])
+
+def test_frames_from_several_threads_do_not_interleave():
+    client = Client(auto_reconnect=False)
+    client.client_socket = SlowSocket()
+    client.connected = True
+
+    def send_many(sender):
+        for number in range(50):
+            client.send_packet({"type": "message", "content": f"{sender}-{number}"})
+
+    threads = [threading.Thread(target=send_many, args=(sender,)) for sender in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    packets = [decode_packet(frame) for frame in FrameDecoder().feed(bytes(client.client_socket.stream))]
+    assert sorted(packet["content"] for packet in packets) == sorted(f"{s}-{n}" for s in range(4) for n in range(50))
@@ -0,0 +1,124 @@
+import socket
+import sqlite3
+import time
+import pytest
+import federation
+from server import create_server
+
+NODES = ("A", "B", "C")
+
+# A dials B and C, B dials C, so every message crosses more than one path to
+# each node and the watermarks have duplicates to drop
+DIALS = {"A": ("B", "C"), "B": ("C",), "C": ()}
+
+@pytest.fixture(autouse=True)
+def quick_reconnect(monkeypatch):
+    monkeypatch.setattr(federation, "RECONNECT_DELAY", 0.2)
+
+def free_port():
+    """Return a port nothing is listening on"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def wait_for(condition, timeout=10):
+    """Poll until condition() is true, failing the test on timeout"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail("Timed out waiting for the nodes")
+        time.sleep(0.05)
+
+def peer_count(node):
+    return node.stats()["gauges"]["peers"]
+
+def stored(path):
+    """Return (content, origin, origin_id) of every message in a node's database"""
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT content, origin, origin_id FROM messages ORDER BY id").fetchall()
+
+class Network:
+    """Three federated nodes on localhost, each with its own database"""
+
+    def __init__(self, engine, directory):
+        self.engine = engine
+        self.directory = directory
+        self.ports = {name: free_port() for name in NODES}
+        self.nodes = {}
+
+    def db_file(self, name):
+        return str(self.directory / f"{name}.db")
+
+    def start(self, name):
+        node = create_server(
+            self.engine, "127.0.0.1", self.ports[name], db_file=self.db_file(name), auth_processes=0,
+            archive_dir=str(self.directory / f"{name}-archive"), node=name, peer_secret="s3cret",
+            peers=[f"127.0.0.1:{self.ports[peer]}" for peer in DIALS[name]]
+        )
+        assert node.start()
+        self.nodes[name] = node
+        return node
+
+    def stop(self, name):
+        self.nodes.pop(name).stop()
+
+    def received(self, name):
+        return self.nodes[name].metrics.snapshot()["counters"].get("federation.received", 0)
+
+    def linked(self):
+        return all(peer_count(node) == 2 for node in self.nodes.values())
+
+@pytest.fixture(params=["threaded", "asyncio"])
+def network(request, tmp_path):
+    network = Network(request.param, tmp_path)
+    yield network
+    for name in list(network.nodes):
+        network.stop(name)
+
+def test_peering_refuses_memory_persistence():
+    with pytest.raises(ValueError):
+        create_server("threaded", "127.0.0.1", free_port(), persistence="memory", node="A", peer_secret="s3cret")
+
+def test_relay_dedup_and_catch_up(network):
+    for name in ("C", "B", "A"):
+        network.start(name)
+    wait_for(network.linked)
+
+    # Every node posts; every message reaches every node exactly once
+    for round_number in range(3):
+        for name in NODES:
+            network.nodes[name].broadcast_message("admin", f"{name}{round_number}")
+    wait_for(lambda: all(network.received(name) == 6 for name in NODES))
+    duplicates = sum(node.metrics.snapshot()["counters"].get("federation.duplicates", 0) for node in network.nodes.values())
+    assert duplicates > 0
+
+    # B misses what A and C post while it is down, and catches up when it is back
+    network.stop("B")
+    for number in range(5):
+        network.nodes["A"].broadcast_message("admin", f"A-down{number}")
+        network.nodes["C"].broadcast_message("admin", f"C-down{number}")
+    network.start("B")
+    wait_for(lambda: network.linked() and network.received("B") == 10)
+
+    for name in list(network.nodes):
+        network.stop(name)
+
+    expected = {f"{name}{number}" for name in NODES for number in range(3)}
+    expected |= {f"{name}-down{number}" for name in "AC" for number in range(5)}
+    for name in NODES:
+        rows = stored(network.db_file(name))
+        assert sorted(content for content, _, _ in rows) == sorted(expected)
+
+        # Relayed rows keep where they came from; local ones have no origin
+        for content, origin, origin_id in rows:
+            if content.startswith(name):
+                assert origin is None
+            else:
+                assert origin == content[0] and origin_id > 0
+
+    # The same message has the same origin pair on every node that relayed it
+    pairs = {}
+    for name in NODES:
+        for content, origin, origin_id in stored(network.db_file(name)):
+            if origin:
+                assert pairs.setdefault(content, (origin, origin_id)) == (origin, origin_id)
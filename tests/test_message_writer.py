@@ -0,0 +1,43 @@
+import sqlite3
+import pytest
+import message_writer
+from database import Database
+from message_writer import MessageWriter
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "forum.db"))
+    yield db
+    db.close()
+
+def stored_ids(db):
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM messages ORDER BY id")]
+
+def test_batch_is_retried_while_the_database_is_locked(db, monkeypatch):
+    monkeypatch.setattr(message_writer, "WRITE_RETRY_DELAYS", (0.01, 0.01, 0.01))
+    save_messages = db.save_messages
+    failures = [sqlite3.OperationalError("database is locked")] * 2
+
+    def flaky_save(rows):
+        if failures:
+            raise failures.pop()
+        return save_messages(rows)
+
+    monkeypatch.setattr(db, "save_messages", flaky_save)
+    writer = MessageWriter(db, "batched")
+    writer.start()
+    for number in range(20):
+        writer.save("bob", f"message {number}", "2026-10-18 12:00:00")
+    writer.stop()
+
+    assert stored_ids(db) == list(range(1, 21))
+
+def test_flush_waits_for_queued_messages(db):
+    writer = MessageWriter(db, "batched", flush_interval=0.2)
+    writer.start()
+    for number in range(5):
+        writer.save("bob", f"message {number}", "2026-10-18 12:00:00")
+    writer.flush()
+    assert stored_ids(db) == list(range(1, 6))
+    writer.stop()
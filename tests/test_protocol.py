@@ -0,0 +1,95 @@
+import pytest
+from protocol import (
+    COMPACT_CODEC, COMPRESSION_THRESHOLD, DEFLATE_CODECS, JSON_CODEC, MAX_FRAME_SIZE,
+    FrameDecoder, Packet, ProtocolError, decode_packet, encode_frame, pack_timestamp, unpack_timestamp
+)
+
+CODECS = [JSON_CODEC] + ([COMPACT_CODEC] if COMPACT_CODEC else []) + list(DEFLATE_CODECS.values())
+
+def history(count, timestamp="2026-10-18 12:00:00"):
+    """Build a history packet like the server sends after login"""
+    return {
+        "type": "history",
+        "room": "general",
+        "messages": [
+            {"id": 100 + i, "room": "general", "username": f"user{i % 3}", "timestamp": timestamp, "content": f"message {i}"}
+            for i in range(count)
+        ]
+    }
+
+def decode_all(frames):
+    """Feed frames through one decoder and return the packets"""
+    decoder = FrameDecoder()
+    return [decode_packet(frame) for frame in decoder.feed(b"".join(frames))]
+
+@pytest.mark.parametrize("codec", CODECS, ids=lambda codec: codec.name)
+@pytest.mark.parametrize("packet", [
+    {"type": "message", "id": 7, "room": "dev", "username": "bob", "timestamp": "2026-10-18 12:00:00", "content": "hi", "system": False},
+    {"type": "login_response", "success": True, "capabilities": ["length-prefix"], "token": None},
+    history(1),
+    history(300),
+    {"type": "history", "room": "general", "messages": []},
+    {"type": "some_future_type", "unknown_field": {"nested": [1, 2]}}
+], ids=["message", "login_response", "history-1", "history-300", "history-empty", "unknown"])
+def test_codec_round_trip(codec, packet):
+    assert decode_all([codec.encode(packet)]) == [packet]
+
+@pytest.mark.parametrize("codec", CODECS, ids=lambda codec: codec.name)
+@pytest.mark.parametrize("timestamp", ["2026-02-30 10:00:00", "2026-10-18 25:00:00", "0001-01-01 00:00:00", "yesterday"])
+def test_codec_keeps_invalid_timestamps(codec, timestamp):
+    packet = history(3, timestamp)
+    packet["timestamp"] = timestamp
+    assert decode_all([codec.encode(packet)]) == [packet]
+
+def test_pack_timestamp_round_trips():
+    assert unpack_timestamp(pack_timestamp("2026-10-18 12:34:56")) == "2026-10-18 12:34:56"
+    assert isinstance(pack_timestamp("2026-10-18 12:34:56"), int)
+    assert pack_timestamp("2026-02-30 10:00:00") == "2026-02-30 10:00:00"
+
+def test_deflate_compresses_large_frames_only():
+    codec = DEFLATE_CODECS["json"]
+    small = {"type": "message", "content": "hi"}
+    large = history(300)
+    assert codec.encode(small) == JSON_CODEC.encode(small)
+    assert len(JSON_CODEC.body(large)) >= COMPRESSION_THRESHOLD
+    assert len(codec.encode(large)) < len(JSON_CODEC.encode(large)) // 2
+
+def test_shared_packet_encodes_once_per_codec():
+    packet = Packet(history(50))
+    for codec in CODECS:
+        assert packet.frame(codec) is packet.frame(codec)
+        assert decode_all([packet.frame(codec)]) == [packet.data]
+
+def test_frame_decoder_reassembles_split_frames():
+    packets = [history(i) for i in range(0, 200, 40)]
+    stream = b"".join(codec.encode(packet) for codec in CODECS for packet in packets)
+
+    # One byte at a time, then in uneven chunks
+    for chunk_size in (1, 7, 4096):
+        decoder = FrameDecoder()
+        frames = []
+        for offset in range(0, len(stream), chunk_size):
+            frames.extend(decoder.feed(stream[offset:offset + chunk_size]))
+        assert [decode_packet(frame) for frame in frames] == packets * len(CODECS)
+        assert decoder.pending() == 0
+
+def test_frame_decoder_keeps_partial_frames():
+    frame = JSON_CODEC.encode({"type": "message", "content": "hello"})
+    decoder = FrameDecoder()
+    assert decoder.feed(frame[:-1]) == []
+    assert decoder.pending() == len(frame) - 1
+    assert len(decoder.feed(frame[-1:])) == 1
+
+def test_frame_decoder_rejects_oversized_frames():
+    decoder = FrameDecoder(max_frame_size=1024)
+    with pytest.raises(ProtocolError):
+        decoder.feed(encode_frame(b"{" + b" " * 2048 + b"}"))
+
+def test_encode_frame_rejects_oversized_payloads():
+    with pytest.raises(ProtocolError):
+        encode_frame(b"x" * (MAX_FRAME_SIZE + 1))
+
+def test_frame_decoder_rejects_corrupt_compressed_frames():
+    decoder = FrameDecoder()
+    with pytest.raises(ProtocolError):
+        decoder.feed(encode_frame(b"not deflate data", compressed=True))
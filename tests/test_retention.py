@@ -0,0 +1,64 @@
+import pytest
+from database import Database
+from message_writer import MessageWriter
+from retention import RetentionManager, read_segment
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / "forum.db")
+
+def write_messages(db, count):
+    writer = MessageWriter(db, "sync")
+    for number in range(count):
+        writer.save("bob", f"message {number}", "2020-01-01 12:00:00")
+
+def test_ids_are_not_reused_after_everything_is_archived(db_file, tmp_path):
+    db = Database(db_file)
+    write_messages(db, 5)
+    retention = RetentionManager(db, max_rows=0, archive_dir=str(tmp_path / "archive"))
+    assert retention.run_once() == 5
+    db.close()
+
+    # A restart seeds the ids from the archive, not from the now empty table
+    db = Database(db_file)
+    assert MessageWriter(db, "sync").save("bob", "after", "2026-10-18 12:00:00")["id"] == 6
+    db.close()
+
+def test_direct_message_ids_are_not_reused_after_deletion(db_file):
+    db = Database(db_file)
+    writer = MessageWriter(db, "sync")
+    for number in range(3):
+        writer.save_direct("bob", "amy", f"hello {number}", "2026-10-18 12:00:00")
+    with db.connection() as conn:
+        conn.execute("DELETE FROM direct_messages")
+        conn.commit()
+    db.close()
+
+    db = Database(db_file)
+    assert MessageWriter(db, "sync").save_direct("bob", "amy", "again", "2026-10-18 12:00:00")["id"] == 4
+    db.close()
+
+def test_archived_messages_page_back(db_file, tmp_path):
+    db = Database(db_file)
+    write_messages(db, 30)
+    retention = RetentionManager(db, max_rows=10, archive_dir=str(tmp_path / "archive"), segment_size=8)
+    assert retention.run_once() == 20
+    assert [m["id"] for m in retention.get_messages_before(15, 5, "general")] == list(range(10, 15))
+    db.close()
+
+def test_truncated_segment_reads_as_empty(tmp_path):
+    db = Database(str(tmp_path / "forum.db"))
+    write_messages(db, 20)
+    retention = RetentionManager(db, max_rows=0, archive_dir=str(tmp_path / "archive"))
+    retention.run_once()
+    segment = db.get_archive_segments("general", 100)[0]["path"]
+    db.close()
+
+    with open(segment, "rb") as f:
+        data = f.read()
+    truncated = str(tmp_path / "truncated.jsonl.gz")
+    with open(truncated, "wb") as f:
+        f.write(data[:len(data) // 2])
+
+    assert len(read_segment(segment)) == 20
+    assert read_segment(truncated) == ()
@@ -0,0 +1,125 @@
+import time
+import threading
+import pytest
+from history import HistoryCache
+from server import Server
+
+@pytest.fixture
+def server(tmp_path):
+    server = Server(db_file=str(tmp_path / "forum.db"), archive_dir=str(tmp_path / "archive"), auth_processes=0)
+    server.writer.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def slow_writes(server, monkeypatch):
+    """Make every commit slow, so broadcast messages wait in the write-behind queue"""
+    save_messages = server.db.save_messages
+
+    def slow_save(rows):
+        time.sleep(0.05)
+        return save_messages(rows)
+
+    monkeypatch.setattr(server.db, "save_messages", slow_save)
+
+def broadcast(server, count):
+    for number in range(count):
+        server.broadcast_message("bob", f"message {number}")
+
+def test_history_page_includes_messages_still_queued(server, slow_writes):
+    broadcast(server, 300)
+
+    # The ring holds 201-300; the page before it has to come from the database
+    messages, has_more = server.get_history_page(201, 50)
+    assert [m["id"] for m in messages] == list(range(151, 201))
+    assert has_more
+
+def test_history_page_reaches_the_first_message(server):
+    broadcast(server, 30)
+    messages, has_more = server.get_history_page(11, 50)
+    assert [m["id"] for m in messages] == list(range(1, 11))
+    assert not has_more
+
+def resync(server, last_seen_id):
+    """Return the packets a client reconnecting with last_seen_id is sent"""
+    packets = []
+    server.send_message_history(packets.append, last_seen_id)
+    return [packet.data if hasattr(packet, "data") else packet for packet in packets]
+
+def resynced_ids(packets):
+    return [m["id"] for packet in packets if packet["type"] == "message_history" for m in packet["messages"]]
+
+def test_resync_sends_only_the_delta(server):
+    broadcast(server, 50)
+    packets = resync(server, 40)
+    assert [packet["type"] for packet in packets] == ["message_history"]
+    assert resynced_ids(packets) == list(range(41, 51))
+
+def test_resync_reads_the_gap_before_the_ring(server):
+    broadcast(server, 300)
+    packets = resync(server, 150)
+    assert resynced_ids(packets) == list(range(151, 301))
+
+def test_resync_includes_messages_still_queued(server, slow_writes):
+    broadcast(server, 300)
+    packets = resync(server, 0)
+    assert "history_reset" not in [packet["type"] for packet in packets]
+    assert resynced_ids(packets) == list(range(1, 301))
+
+def test_resync_resets_a_client_too_far_behind(server, monkeypatch):
+    monkeypatch.setattr("server.MAX_RESYNC_MESSAGES", 50)
+    broadcast(server, 300)
+    packets = resync(server, 10)
+    assert packets[0] == {"type": "history_reset", "room": "general"}
+    assert [m["id"] for m in packets[1]["messages"]] == list(range(201, 301))
+
+def test_resync_resets_a_client_ahead_of_the_server(server):
+    broadcast(server, 5)
+    assert resync(server, 99)[0]["type"] == "history_reset"
+
+def test_direct_messages_arrive_in_id_order(server):
+    received = []
+    server.clients.add("amy", "user", received.append)
+    senders = [server.clients.add(f"user{number}", "user", lambda packet: None) for number in range(8)]
+
+    def send_many(sender):
+        for number in range(100):
+            server.send_direct_message(sender, "amy", f"hello {number}")
+
+    threads = [threading.Thread(target=send_many, args=(sender,)) for sender in senders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ids = [packet.data["id"] for packet in received]
+    assert ids == list(range(1, 801))
+
+def test_paging_rooms_nobody_joined_creates_no_rings(server):
+    for number in range(50):
+        server.get_history_page(100, 50, f"room{number}")
+    assert list(server.histories) == ["general"]
+
+def test_ring_is_dropped_when_the_room_empties_and_rebuilt_on_join(server):
+    amy = server.clients.add("amy", "user", lambda packet: None)
+    server.join_room(amy, "dev")
+    server.broadcast_message("amy", "first", room="dev")
+    assert "dev" in server.histories
+
+    server.leave_room(amy, "dev")
+    assert "dev" not in server.histories
+
+    # Posted while the room has no ring; the next join reads it back
+    server.broadcast_message("bob", "second", room="dev")
+    server.join_room(amy, "dev")
+    assert [m["content"] for m in server.histories["dev"].snapshot()] == ["first", "second"]
+
+    server.logout_client(amy)
+    assert "dev" not in server.histories
+    assert "general" in server.histories
+
+def test_warm_keeps_messages_appended_meanwhile():
+    history = HistoryCache(100, "dev")
+    history.append({"id": 5})
+    history.warm([{"id": number} for number in range(1, 6)])
+    assert [m["id"] for m in history.snapshot()] == [1, 2, 3, 4, 5]
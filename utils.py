@@ -20,4 +20,10 @@ def validate_username(username):
 def validate_password(password):
     """Validate password strength"""
     # Password must be at least 8 characters
-    return len(password) >= 8
\ No newline at end of file
+    return len(password) >= 8
+
+def validate_room_name(room):
+    """Validate room name format"""
+    # Room names must be 1-32 characters, alphanumeric, underscores and dashes only
+    pattern = re.compile(r'^[a-zA-Z0-9_-]{1,32}$')
+    return isinstance(room, str) and bool(pattern.match(room))
\ No newline at end of file